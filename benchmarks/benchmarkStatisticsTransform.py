@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import argparse, os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import statisticsTransform
+
+# Parsing command line arguments
+argParser = argparse.ArgumentParser(description='Micro-benchmark of the flattening of campaign statistics into rows on synthetic payloads')
+argParser.add_argument('--campaigns', help='Number of synthetic campaigns (default: 200)', type=int, default=200)
+argParser.add_argument('--days', help='Number of days per campaign (default: 7)', type=int, default=7)
+argParser.add_argument('--messages', help='Number of messages per campaign (default: 10)', type=int, default=10)
+argParser.add_argument('--kpis', help='Number of defined KPIs (default: 60)', type=int, default=60)
+argParser.add_argument('--skip-legacy', help='Only run the indexed implementation', action='store_true')
+args = argParser.parse_args()
+
+KPIS_TO_EXPORT = ['Sent', 'Delivered', 'Viewed', 'Clicked', 'Unique Viewed', 'Unique Clicked', 'Soft Bounced', 'Hard Bounced', 'Marked as Spam', 'Unsubscribed']
+
+# Build synthetic KPI definitions and campaign statistics responses
+kpiDefinitions = [{'id': i + 1, 'name': KPIS_TO_EXPORT[i] if i < len(KPIS_TO_EXPORT) else 'Other KPI ' + str(i)} for i in range(args.kpis)]
+payloads = []
+for c in range(args.campaigns):
+    campaign = {'id': c + 1, 'name': 'Campaign ' + str(c + 1)}
+    messageIds = [str(c) + '-' + str(m) for m in range(args.messages)]
+    campaignStatistics = {
+        'history': {
+            '2020-01-' + str(d + 1).zfill(2) + 'T00:00:00.000Z': [{'id': messageId, 'values': {str(k['id']): d + m + k['id'] for k in kpiDefinitions}} for m, messageId in enumerate(messageIds)]
+            for d in range(args.days)
+        },
+        'description': {messageId: {'name': 'Message ' + messageId, 'channelType': 'MAIL'} for messageId in messageIds}
+    }
+    payloads.append((campaign, campaignStatistics))
+
+# The flattening as originally implemented in fetchMessageStatistcs.py, kept as reference
+def legacyRows(campaign, campaignStatistics, reduced):
+    results = []
+    for day in campaignStatistics['history']:
+        date = day[:10]
+        for messageStatistic in campaignStatistics['history'][day]:
+            messageId = messageStatistic['id']
+            messageDetails = campaignStatistics['description'][messageId]
+            if reduced:
+                result = {
+                    'Date': date,
+                    'Campaign ID': campaign['id'],
+                    'Campaign Name': campaign['name'],
+                    'Message ID': messageId,
+                    'Message Name': messageDetails['name'],
+                    'Message Channel': messageDetails['channelType']
+                }
+                for kpiId in messageStatistic['values']:
+                    value = messageStatistic['values'][kpiId]
+                    if len([kpi for kpi in kpiDefinitions if str(kpi['id']) == kpiId]) == 1:
+                        currentKpi = [kpi for kpi in kpiDefinitions if str(kpi['id']) == kpiId][0]
+                        if currentKpi['name'] in KPIS_TO_EXPORT:
+                            result[currentKpi['name']] = value
+                results.append(result)
+            else:
+                for kpiId in messageStatistic['values']:
+                    value = messageStatistic['values'][kpiId]
+                    if len([kpi for kpi in kpiDefinitions if str(kpi['id']) == kpiId]) == 1:
+                        currentKpi = [kpi for kpi in kpiDefinitions if str(kpi['id']) == kpiId][0]
+                        if currentKpi['name'] in KPIS_TO_EXPORT:
+                            results.append({
+                                'Date': date,
+                                'Campaign ID': campaign['id'],
+                                'Campaign Name': campaign['name'],
+                                'Message ID': messageId,
+                                'Message Name': messageDetails['name'],
+                                'Message Channel': messageDetails['channelType'],
+                                'KPI': currentKpi['name'],
+                                'Value': value
+                            })
+    return results
+
+def indexedRows(campaign, campaignStatistics, reduced):
+    return list(statisticsTransform.buildRows(campaign, campaignStatistics, kpiIndex, reduced))
+
+kpiIndex = statisticsTransform.buildKpiIndex(kpiDefinitions, KPIS_TO_EXPORT)
+print('Payload:', args.campaigns, 'campaigns,', args.days, 'days,', args.messages, 'messages,', args.kpis, 'KPIs')
+for reduced in [False, True]:
+    layout = 'reduced' if reduced else 'long'
+    timings = {}
+    implementations = [('indexed', indexedRows)] if args.skip_legacy else [('legacy', legacyRows), ('indexed', indexedRows)]
+    for name, implementation in implementations:
+        start = time.perf_counter()
+        rowCount = 0
+        for campaign, campaignStatistics in payloads:
+            rowCount += len(implementation(campaign, campaignStatistics, reduced))
+        timings[name] = time.perf_counter() - start
+        print(layout.ljust(8), name.ljust(8), str(rowCount).rjust(9), 'rows', '%9.3f s' % timings[name], '%12.0f rows/s' % (rowCount / timings[name]))
+    if 'legacy' in timings:
+        # The speedup only counts if both implementations produce the same rows
+        for campaign, campaignStatistics in payloads:
+            if legacyRows(campaign, campaignStatistics, reduced) != indexedRows(campaign, campaignStatistics, reduced):
+                print(layout.ljust(8), 'indexed rows differ from the legacy rows for campaign', campaign['id'])
+                sys.exit(1)
+        print(layout.ljust(8), 'speedup ', '%.1fx' % (timings['legacy'] / timings['indexed']))
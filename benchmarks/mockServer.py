@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+import argparse, base64, datetime, json, random, re, socket, threading, time, urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the CrossEngage and Sendgrid endpoints used by the scripts in this repository,
+# with configurable latency, error rate, rate limit and data volumes. Paths are prefixed per upstream service
+# so that one server can play all of them (see baseUrlEnvironment() for the matching variables):
+#   /api      -> https://api.crossengage.io      (XNG_API_BASE_URL)
+#   /ui       -> https://ui-api.crossengage.io/ui (XNG_UI_BASE_URL)
+#   /trk      -> https://trk-api.crossengage.io  (XNG_TRACKING_BASE_URL)
+#   /sendgrid -> https://api.sendgrid.com/v3     (SENDGRID_API_BASE_URL)
+# Suppression i has the email userI@example.com (upper case for every 17th) and was created at
+# 1500000000 + 60 * i. Only a share (matchRate) of these emails belongs to a CrossEngage user.
+
+KPI_NAMES = ['Sent', 'Delivered', 'Viewed', 'Clicked', 'Unique Viewed', 'Unique Clicked', 'Soft Bounced', 'Hard Bounced', 'Marked as Spam', 'Unsubscribed', 'Converted', 'Revenue']
+CHANNELS = ['MAIL', 'WEB_PUSH', 'SMS', 'ONSITE']
+
+# Data volumes, behaviour and counters of the stand-in server, shared by all handler threads
+class MockState:
+    def __init__(self, campaigns=100, messagesPerCampaign=5, suppressions=1000, matchRate=0.5, optedOutRate=0.2, latency=0.0, latencyJitter=0.0, errorRate=0.0, rateLimit=0, seed=1):
+        self.campaigns = campaigns
+        self.messagesPerCampaign = messagesPerCampaign
+        self.suppressions = suppressions
+        self.matchRate = matchRate
+        self.optedOutRate = optedOutRate
+        self.latency = latency
+        self.latencyJitter = latencyJitter
+        self.errorRate = errorRate
+        self.rateLimit = rateLimit
+        self.rateWindow = 0
+        self.rateWindowRequests = 0
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.segments = {}
+        self.nextSegmentId = 1000
+        self.optedOut = set()
+        self.tokens = set()
+        self.requests = 0
+        self.errors = 0
+        self.rateLimited = 0
+        self.bytesSent = 0
+
+    def suppressionEmail(self, i):
+        return 'user' + str(i) + '@example.com'
+
+    def suppressionCreated(self, i):
+        return 1500000000 + i * 60
+
+    def userForEmail(self, email):
+        match = re.match(r'user(\d+)@example\.com', email.lower())
+        if not match:
+            return None
+        i = int(match.group(1))
+        if (i * 7919) % 1000 >= self.matchRate * 1000:
+            return None
+        return {
+            'xngGlobalUserId': 'g-' + str(i),
+            'externalId': ('ext-' + str(i)) if i % 10 else None,
+            'email': email
+        }
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    # Headers and body are written separately, without TCP_NODELAY delayed ACKs would add ~40ms to each response
+    def setup(self):
+        super().setup()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, status, payload=None, headers=None, raw=None):
+        body = raw if raw is not None else (b'' if payload is None else json.dumps(payload).encode('utf-8'))
+        self.send_response(status)
+        if status != 204:
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if status != 204:
+            self.wfile.write(body)
+        with self.state.lock:
+            self.state.bytesSent += len(body)
+
+    def readBody(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def handle_one(self, method):
+        state = self.state
+        body = self.readBody()
+        with state.lock:
+            state.requests += 1
+            failing = state.errorRate and state.random.random() < state.errorRate
+            if failing:
+                state.errors += 1
+            # Allow rateLimit requests per second (per whole second, like a fixed window limiter) and answer the others with 429
+            window = int(time.time())
+            if window != state.rateWindow:
+                state.rateWindow, state.rateWindowRequests = window, 0
+            state.rateWindowRequests += 1
+            limited = state.rateLimit and state.rateWindowRequests > state.rateLimit
+            if limited:
+                state.rateLimited += 1
+            delay = state.latency + state.random.uniform(0, state.latencyJitter)
+        if delay:
+            time.sleep(delay)
+        if limited:
+            return self.send(429, {'error': 'too many requests'}, headers={'Retry-After': '1'})
+        if failing:
+            return self.send(503, {'error': 'injected failure'})
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path
+        if path.startswith('/ui/') and not path.startswith('/ui/managers/'):
+            with state.lock:
+                authorized = (self.headers.get('Authorization') or '')[7:] in state.tokens
+            if not authorized:
+                return self.send(401, {'error': 'invalid token'})
+        query = dict(urllib.parse.parse_qsl(url.query))
+        route = getattr(self, 'route' + method)
+        return route(path, query, body)
+
+    def do_GET(self):
+        self.handle_one('GET')
+
+    def do_POST(self):
+        self.handle_one('POST')
+
+    def do_PUT(self):
+        self.handle_one('PUT')
+
+    def do_DELETE(self):
+        self.handle_one('DELETE')
+
+    def routeGET(self, path, query, body):
+        state = self.state
+        if path == '/api/statistics/kpi':
+            return self.send(200, [{'id': i + 1, 'name': name} for i, name in enumerate(KPI_NAMES)])
+        if path == '/ui/campaigns':
+            return self.send(200, [{'id': i + 1, 'name': 'Campaign ' + str(i + 1)} for i in range(state.campaigns)])
+        match = re.match(r'^/ui/campaign/(\d+)/stats$', path)
+        if match:
+            return self.send(200, self.campaignStatistics(int(match.group(1)), query))
+        if path == '/ui/campaigns/event-classes':
+            return self.send(200, {'properties': [{'label': 'traits.firstName', 'id': 41}, {'label': 'traits.email', 'id': 42}]})
+        match = re.match(r'^/ui/filters/(\d+)/count$', path)
+        if match:
+            with state.lock:
+                users = state.segments.get(int(match.group(1)))
+            if users is None:
+                return self.send(404, {'error': 'unknown segment'})
+            return self.send(200, {'total': len(users)})
+        match = re.match(r'^/ui/userexplorer/(\d+)$', path)
+        if match:
+            with state.lock:
+                users = state.segments.get(int(match.group(1)))
+            if users is None:
+                return self.send(404, {'error': 'unknown segment'})
+            offset = int(query.get('offset', 0))
+            limit = int(query.get('limit', 100))
+            return self.send(200, {'part': users[offset:offset + limit], 'total': len(users)})
+        match = re.match(r'^/api/users/([^/]+)/recipient-status$', path)
+        if match:
+            externalId = match.group(1)
+            i = int(externalId.split('-')[-1])
+            with state.lock:
+                optedOut = externalId in state.optedOut or (i * 31) % 100 < state.optedOutRate * 100
+            return self.send(200, {'optOutAll': optedOut})
+        match = re.match(r'^/trk/optout/inbound/webhook/([^/]+)/([^/]+)$', path)
+        if match:
+            return self.send(200, raw=b'OK')
+        if path == '/sendgrid/suppression/unsubscribes':
+            return self.unsubscribes(query)
+        return self.send(404, {'error': 'not found', 'path': path})
+
+    def routePOST(self, path, query, body):
+        state = self.state
+        if path == '/ui/managers/companies':
+            return self.send(200, [4711])
+        if path == '/ui/managers/login':
+            claims = base64.urlsafe_b64encode(json.dumps({'exp': int(time.time()) + 3600, 'jti': len(state.tokens)}).encode('utf-8')).decode('ascii').rstrip('=')
+            token = 'eyJhbGciOiJub25lIn0.' + claims + '.mock'
+            with state.lock:
+                state.tokens.add(token)
+            return self.send(200, {'token': token})
+        if path == '/ui/campaigns/filters':
+            segment = json.loads(body.decode('utf-8'))
+            emails = []
+            for subFilter in segment.get('subFilters', []):
+                for condition in subFilter.get('conditions', []):
+                    emails.extend(condition.get('values', []))
+            users = [user for user in (state.userForEmail(email) for email in emails) if user]
+            with state.lock:
+                state.nextSegmentId += 1
+                segmentId = state.nextSegmentId
+                state.segments[segmentId] = users
+            return self.send(200, {'id': segmentId, 'label': segment.get('label')})
+        return self.send(404, {'error': 'not found', 'path': path})
+
+    def routePUT(self, path, query, body):
+        state = self.state
+        match = re.match(r'^/api/users/([^/]+)/optout-status$', path)
+        if match:
+            with state.lock:
+                state.optedOut.add(match.group(1))
+            return self.send(200, {'optOut': True})
+        return self.send(404, {'error': 'not found', 'path': path})
+
+    def routeDELETE(self, path, query, body):
+        state = self.state
+        match = re.match(r'^/ui/filters/(\d+)$', path)
+        if match:
+            with state.lock:
+                found = state.segments.pop(int(match.group(1)), None) is not None
+            return self.send(204 if found else 404)
+        return self.send(404, {'error': 'not found', 'path': path})
+
+    def campaignStatistics(self, campaignId, query):
+        day = datetime.date.fromisoformat(query.get('startDate', '2020-01-01')[:10])
+        end = datetime.date.fromisoformat(query.get('endDate', str(day))[:10])
+        history = {}
+        description = {}
+        messageIds = [str(campaignId) + '-' + str(m) for m in range(self.state.messagesPerCampaign)]
+        for m, messageId in enumerate(messageIds):
+            description[messageId] = {'name': 'Message ' + str(m + 1), 'channelType': CHANNELS[(campaignId + m) % len(CHANNELS)]}
+        while day <= end:
+            history[str(day) + 'T00:00:00.000Z'] = [{'id': messageId, 'values': {str(k + 1): (campaignId * 13 + m * 7 + k) % 1000 for k in range(len(KPI_NAMES))}} for m, messageId in enumerate(messageIds)]
+            day += datetime.timedelta(1)
+        return {'history': history, 'description': description}
+
+    def unsubscribes(self, query):
+        state = self.state
+        limit = min(int(query.get('limit', 500)), 500)
+        offset = int(query.get('offset', 0))
+        startTime = int(query['start_time']) if 'start_time' in query else None
+        endTime = int(query['end_time']) if 'end_time' in query else None
+        first = 0
+        last = state.suppressions
+        if startTime is not None:
+            first = min(max(0, -(-(startTime - 1500000000) // 60)), state.suppressions)
+        if endTime is not None:
+            last = max(first, min(state.suppressions, (endTime - 1500000000) // 60 + 1))
+        indexes = range(first + offset, min(last, first + offset + limit))
+        page = [{'email': state.suppressionEmail(i) if i % 17 else state.suppressionEmail(i).upper(), 'created': state.suppressionCreated(i)} for i in indexes]
+        # Like Sendgrid, the next link of the last page points to the last page itself
+        nextQuery = dict(query)
+        nextQuery['limit'] = str(limit)
+        nextQuery['offset'] = str(offset + limit if first + offset + limit < last else offset)
+        headers = {'Link': '<http://' + self.headers.get('Host') + '/sendgrid/suppression/unsubscribes?' + urllib.parse.urlencode(nextQuery) + '>; rel="next"'}
+        return self.send(200, page, headers=headers)
+
+# Start the server in a background thread, port 0 picks a free port
+def startServer(state, host='127.0.0.1', port=0):
+    handler = type('BoundMockHandler', (MockHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+# Environment variables pointing the scripts of this repository to the given server
+def baseUrlEnvironment(server):
+    baseUrl = 'http://' + server.server_address[0] + ':' + str(server.server_address[1])
+    return {
+        'XNG_API_BASE_URL': baseUrl + '/api',
+        'XNG_UI_BASE_URL': baseUrl + '/ui',
+        'XNG_TRACKING_BASE_URL': baseUrl + '/trk',
+        'SENDGRID_API_BASE_URL': baseUrl + '/sendgrid'
+    }
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Runs a local stand-in for the CrossEngage and Sendgrid APIs')
+    argParser.add_argument('--port', help='Port to listen on (default: 8765)', type=int, default=8765)
+    argParser.add_argument('--campaigns', help='Number of campaigns (default: 100)', type=int, default=100)
+    argParser.add_argument('--messages', help='Number of messages per campaign (default: 5)', type=int, default=5)
+    argParser.add_argument('--suppressions', help='Number of Sendgrid global unsubscribes (default: 1000)', type=int, default=1000)
+    argParser.add_argument('--match-rate', help='Share of unsubscribed emails that belong to a CrossEngage user (default: 0.5)', type=float, default=0.5)
+    argParser.add_argument('--latency', help='Latency of every response in seconds (default: 0)', type=float, default=0.0)
+    argParser.add_argument('--latency-jitter', help='Maximum random latency added on top in seconds (default: 0)', type=float, default=0.0)
+    argParser.add_argument('--error-rate', help='Share of requests answered with 503 (default: 0)', type=float, default=0.0)
+    argParser.add_argument('--rate-limit', help='Requests per second answered before the others get 429 Too Many Requests (default: unlimited)', type=int, default=0)
+    args = argParser.parse_args()
+    state = MockState(campaigns=args.campaigns, messagesPerCampaign=args.messages, suppressions=args.suppressions, matchRate=args.match_rate, latency=args.latency, latencyJitter=args.latency_jitter, errorRate=args.error_rate, rateLimit=args.rate_limit)
+    server = startServer(state, port=args.port)
+    print('Mock server listening on port', server.server_address[1])
+    for key, value in baseUrlEnvironment(server).items():
+        print(key + '=' + value)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
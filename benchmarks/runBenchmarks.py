@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import argparse, json, os, subprocess, sys, tempfile, time
+
+import mockServer
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Fixed scenarios: the script to run with its arguments and the settings of the stand-in server
+SCENARIOS = {
+    'statistics-5k-campaigns': {
+        'description': 'Yesterday\'s statistics of 5000 campaigns with 5 messages each',
+        'script': 'fetchMessageStatistcs.py',
+        'arguments': ['--no-cache', '-w', '16', 'output.csv'],
+        'mock': {'campaigns': 5000, 'messagesPerCampaign': 5, 'latency': 0.02}
+    },
+    'statistics-5k-campaigns-reduced': {
+        'description': 'Yesterday\'s statistics of 5000 campaigns in the reduced layout',
+        'script': 'fetchMessageStatistcs.py',
+        'arguments': ['--no-cache', '-w', '16', '-r', 'output.csv'],
+        'mock': {'campaigns': 5000, 'messagesPerCampaign': 5, 'latency': 0.02}
+    },
+    'statistics-backfill-30-days': {
+        'description': '30 days of statistics of 200 campaigns with 20 messages each',
+        'script': 'fetchMessageStatistcs.py',
+        'arguments': ['--no-cache', '-w', '16', '-s', '2020-01-01', '-e', '2020-01-30', 'output.csv'],
+        'mock': {'campaigns': 200, 'messagesPerCampaign': 20, 'latency': 0.02}
+    },
+    'suppressions-100k': {
+        'description': '100k Sendgrid global unsubscribes, 1% of them CrossEngage users',
+        'script': 'optOutSendgridGlobalSuppressions.py',
+        'arguments': [],
+        'mock': {'suppressions': 100000, 'matchRate': 0.01, 'latency': 0.01}
+    },
+    'suppressions-1m': {
+        'description': '1M Sendgrid global unsubscribes, 0.1% of them CrossEngage users',
+        'script': 'optOutSendgridGlobalSuppressions.py',
+        'arguments': [],
+        'mock': {'suppressions': 1000000, 'matchRate': 0.001, 'latency': 0.01}
+    }
+}
+SCALED_SETTINGS = ['campaigns', 'suppressions']
+
+# Parsing command line arguments
+argParser = argparse.ArgumentParser(description='Runs the scripts of this repository against a local stand-in for the CrossEngage and Sendgrid APIs and reports wall time, requests per second and peak memory')
+argParser.add_argument('scenarios', help='Scenarios to run (default: all)', nargs='*')
+argParser.add_argument('-l', '--list', help='List the available scenarios and exit', action='store_true')
+argParser.add_argument('--scale', help='Multiply the number of campaigns and suppressions of every scenario, e.g. 0.1 for a quick run (default: 1)', type=float, default=1.0)
+argParser.add_argument('--latency', help='Override the response latency of the stand-in server in seconds', type=float)
+argParser.add_argument('--error-rate', help='Share of requests the stand-in server answers with 503 (default: 0)', type=float, default=0.0)
+argParser.add_argument('--report', help='Also write the results as JSON into this file')
+argParser.add_argument('-v', '--verbose', help='Show the output of the scripts', action='store_true')
+args = argParser.parse_args()
+
+if args.list:
+    for name, scenario in SCENARIOS.items():
+        print(name.ljust(34), scenario['description'])
+    sys.exit(0)
+for name in args.scenarios:
+    if name not in SCENARIOS:
+        argParser.error('unknown scenario ' + name + ', use --list to show the available scenarios')
+
+# Run a single scenario in a fresh working and home directory (so no caches are re-used)
+def runScenario(name, scenario):
+    settings = dict(scenario['mock'])
+    for setting in SCALED_SETTINGS:
+        if setting in settings:
+            settings[setting] = max(1, int(settings[setting] * args.scale))
+    if args.latency is not None:
+        settings['latency'] = args.latency
+    settings['errorRate'] = args.error_rate
+    state = mockServer.MockState(**settings)
+    server = mockServer.startServer(state)
+    try:
+        with tempfile.TemporaryDirectory() as workingDirectory:
+            environment = dict(os.environ)
+            environment.update(mockServer.baseUrlEnvironment(server))
+            environment.update({
+                'HOME': workingDirectory,
+                'XNG_MASTER_API_KEY': 'benchmark-api-key',
+                'XNG_APP_USER': 'benchmark@example.com',
+                'XNG_APP_PASSWORD': 'benchmark-password',
+                'XNG_WEB_TRACKING_KEY': 'benchmark-tracking-key',
+                'SENDGRID_API_KEY': 'SG.benchmark-key'
+            })
+            command = [sys.executable, os.path.join(REPOSITORY_DIRECTORY, scenario['script'])] + scenario['arguments']
+            output = None if args.verbose else subprocess.DEVNULL
+            start = time.perf_counter()
+            process = subprocess.Popen(command, cwd=workingDirectory, env=environment, stdout=output, stderr=output)
+            _, status, usage = os.wait4(process.pid, 0) # Unlike getrusage(), wait4() reports the peak memory of this process only
+            wallTime = time.perf_counter() - start
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {
+        'scenario': name,
+        'settings': settings,
+        'exitCode': process.returncode,
+        'wallTime': round(wallTime, 3),
+        'requests': state.requests,
+        'injectedErrors': state.errors,
+        'requestsPerSecond': round(state.requests / wallTime, 1),
+        'responseBytes': state.bytesSent,
+        'peakRssKb': usage.ru_maxrss if sys.platform != 'darwin' else usage.ru_maxrss // 1024
+    }
+
+results = []
+print('scenario'.ljust(34), 'exit', 'wall time'.rjust(10), 'requests'.rjust(9), 'req/s'.rjust(8), 'peak RSS'.rjust(10))
+for name in args.scenarios or list(SCENARIOS):
+    result = runScenario(name, SCENARIOS[name])
+    results.append(result)
+    print(name.ljust(34), str(result['exitCode']).rjust(4), ('%.2f s' % result['wallTime']).rjust(10), str(result['requests']).rjust(9), ('%.1f' % result['requestsPerSecond']).rjust(8), ('%.1f MB' % (result['peakRssKb'] / 1024)).rjust(10))
+if args.report:
+    with open(args.report, 'w', encoding='utf-8') as reportFile:
+        json.dump(results, reportFile, indent=2)
+    print('Wrote report to', args.report)
+sys.exit(1 if any(result['exitCode'] != 0 for result in results) else 0)
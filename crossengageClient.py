@@ -0,0 +1,165 @@
+# Shared client for the CrossEngage APIs used by the scripts in this repository.
+# It identifies the company ID, logs in to the UI API and keeps both on disk until the
+# token expires, so consecutive runs do not have to repeat the login round trips.
+# requests is only imported once a session is created to keep the startup fast.
+# The base URLs can be overridden through the XNG_API_BASE_URL and XNG_UI_BASE_URL
+# environment variables, e.g. to run against the stand-in server in benchmarks/mockServer.py.
+
+import base64, json, os, threading, time
+
+API_BASE_URL = 'https://api.crossengage.io'
+UI_BASE_URL = 'https://ui-api.crossengage.io/ui'
+SESSION_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'crossengage-python-snippets', 'session.json')
+DEFAULT_TOKEN_LIFETIME = 3600 # Used for UI tokens whose expiry can not be read from the token itself
+TOKEN_EXPIRY_MARGIN = 300 # Tokens expiring within this many seconds are not used anymore
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+# Create a re-usable session with a connection pool of the given size for each host.
+# Connection errors and 5xx responses are retried with exponential backoff (0.5, 1, 2, ... seconds,
+# or as long as a Retry-After header asks). POST requests are only retried if they could not be sent,
+# 429 responses are left to the rate limiter of the caller. These retries happen below the rate limiter:
+# a request sent through TokenBucket.send() takes one token, however often it is repeated here, so while a
+# server answers with 5xx a limited caller may send up to maxRetries + 1 times its budget.
+def createSession(poolSize=10, maxRetries=3, backoffFactor=0.5):
+    import requests
+    class TransportRetry(requests.adapters.Retry):
+        RETRY_AFTER_STATUS_CODES = frozenset([503]) # Retry would otherwise also repeat 429 responses with a Retry-After header
+    retry = TransportRetry(total=maxRetries, backoff_factor=backoffFactor, status_forcelist=RETRY_STATUS_CODES, raise_on_status=False)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=poolSize, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Read the expiry timestamp from the payload of a JWT, None if the token is not a JWT
+def readTokenExpiry(token):
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).decode('utf-8'))
+        return int(claims['exp'])
+    except Exception:
+        return None
+
+class CrossEngageClient:
+    def __init__(self, apiKey, user, password, apiVersion=2, poolSize=10, timeout=60, sessionCacheFile=SESSION_CACHE_FILE, metrics=None):
+        self.apiKey = apiKey
+        self.user = user
+        self.password = password
+        self.apiVersion = apiVersion
+        self.timeout = timeout
+        self.apiBaseUrl = os.getenv('XNG_API_BASE_URL', API_BASE_URL)
+        self.uiBaseUrl = os.getenv('XNG_UI_BASE_URL', UI_BASE_URL)
+        self.sessionCacheFile = sessionCacheFile
+        self.sessionCacheKey = self.user if self.uiBaseUrl == UI_BASE_URL else self.user + ' ' + self.uiBaseUrl
+        self.session = createSession(poolSize)
+        if metrics is not None:
+            metrics.instrument(self.session)
+        self.lock = threading.Lock()
+        self.companyId = None
+        self.uiToken = None
+        self.tokenExpiresAt = 0
+
+    # Make sure there is a company ID and a valid UI token, from the session cache if possible
+    def login(self):
+        with self.lock:
+            cachedSession = self.readSessionCache()
+            if cachedSession.get('companyId') is not None:
+                self.companyId = cachedSession['companyId']
+                print('Using cached company ID', self.companyId)
+            else:
+                self.companyId = self.fetchCompanyId()
+                print('Found company ID', self.companyId)
+            if cachedSession.get('token') and cachedSession.get('expiresAt', 0) - TOKEN_EXPIRY_MARGIN > time.time():
+                self.uiToken = cachedSession['token']
+                self.tokenExpiresAt = cachedSession['expiresAt']
+                print('Using cached UI token (last 5 characters):', self.uiToken[-5:])
+            else:
+                self.fetchUiToken()
+        return self
+
+    def fetchCompanyId(self):
+        companyIdResponse = self.session.post(self.uiBaseUrl + '/managers/companies', data=json.dumps({'email': self.user}), timeout=self.timeout)
+        if companyIdResponse.status_code == 200:
+            companyIds = json.loads(companyIdResponse.text)
+            if len(companyIds) != 1:
+                raise ValueError('Unexpected number of company IDs returned: ' + companyIdResponse.text)
+            return companyIds[0]
+        else:
+            raise ValueError('Unexpected response code ' + str(companyIdResponse.status_code) + ' when fetching company ID')
+
+    # Log in to the UI API and store the new token in the session cache (caller holds the lock)
+    def fetchUiToken(self):
+        uiTokenPayload = {
+            'email': self.user,
+            'password': self.password
+        }
+        uiTokenHeaders = {
+            'content-type': 'application/json',
+            'company-id': str(self.companyId)
+        }
+        uiTokenResponse = self.session.post(self.uiBaseUrl + '/managers/login', data=json.dumps(uiTokenPayload), headers=uiTokenHeaders, timeout=self.timeout)
+        if uiTokenResponse.status_code == 200:
+            self.uiToken = json.loads(uiTokenResponse.text)['token']
+            self.tokenExpiresAt = readTokenExpiry(self.uiToken) or int(time.time()) + DEFAULT_TOKEN_LIFETIME
+            print('Retrieved UI token (last 5 characters):', self.uiToken[-5:])
+        else:
+            raise ValueError('Unexpected response code ' + str(uiTokenResponse.status_code) + ' when fetching UI token')
+        self.writeSessionCache()
+
+    def readSessionCache(self):
+        try:
+            with open(self.sessionCacheFile, 'r', encoding='utf-8') as cacheFile:
+                return json.load(cacheFile).get(self.sessionCacheKey, {})
+        except (OSError, ValueError):
+            return {}
+
+    def writeSessionCache(self):
+        try:
+            try:
+                with open(self.sessionCacheFile, 'r', encoding='utf-8') as cacheFile:
+                    cachedSessions = json.load(cacheFile)
+            except (OSError, ValueError):
+                cachedSessions = {}
+            cachedSessions[self.sessionCacheKey] = {'companyId': self.companyId, 'token': self.uiToken, 'expiresAt': self.tokenExpiresAt}
+            os.makedirs(os.path.dirname(self.sessionCacheFile), exist_ok=True)
+            temporaryFile = self.sessionCacheFile + '.' + str(os.getpid()) + '.tmp'
+            with open(os.open(temporaryFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as cacheFile:
+                json.dump(cachedSessions, cacheFile)
+            os.replace(temporaryFile, self.sessionCacheFile)
+        except OSError as error:
+            print('Could not write session cache', self.sessionCacheFile + ':', error)
+
+    def apiHeaders(self, apiVersion=None):
+        return {
+            'Content-Type': 'application/json',
+            'X-XNG-ApiVersion': str(apiVersion or self.apiVersion),
+            'X-XNG-AuthToken': self.apiKey
+        }
+
+    def uiHeaders(self):
+        return {
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+            'Company-ID': str(self.companyId),
+            'X-XNG-ApiVersion': str(2),
+            'Authorization': 'Bearer ' + self.uiToken
+        }
+
+    # Send a request to the public API (authenticated with the master API key)
+    def api(self, method, path, apiVersion=None, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, self.apiBaseUrl + path, headers=self.apiHeaders(apiVersion), **kwargs)
+
+    # Send a request to the UI API, logging in again once if the token was rejected
+    def ui(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        uiToken = self.uiToken
+        response = self.session.request(method, self.uiBaseUrl + path, headers=self.uiHeaders(), **kwargs)
+        if response.status_code == 401:
+            response.close()
+            with self.lock:
+                if self.uiToken == uiToken: # Another thread may have refreshed the token in the meantime
+                    print('UI token was rejected, logging in again')
+                    self.fetchUiToken()
+            response = self.session.request(method, self.uiBaseUrl + path, headers=self.uiHeaders(), **kwargs)
+        return response
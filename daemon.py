@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import argparse, dotenv, os, datetime, time, traceback, sys, json, shlex, signal, threading, http.server
+import crossengageClient, fetchMessageStatistcs, lineOutput, metadataCache, optOutSendgridGlobalSuppressions, requestMetrics
+
+lineOutput.install() # Both jobs print concurrently
+
+# Parsing command line arguments
+argParser = argparse.ArgumentParser(description='Runs fetchMessageStatistcs.py and optOutSendgridGlobalSuppressions.py on intervals in one long-running process, sharing one logged in client with warm connections')
+argParser.add_argument('--statistics-interval', help='Minutes between the starts of two statistics exports, 0 disables them (default: 1440)', type=float, default=1440)
+argParser.add_argument('--statistics-args', help='Command line for each statistics export, as for fetchMessageStatistcs.py (default: statistics.csv)', default='statistics.csv')
+argParser.add_argument('--suppressions-interval', help='Minutes between the starts of two Sendgrid opt-out syncs, 0 disables them (default: 60)', type=float, default=60)
+argParser.add_argument('--suppressions-args', help='Command line for each Sendgrid opt-out sync, as for optOutSendgridGlobalSuppressions.py (default: none)', default='')
+argParser.add_argument('--metadata-ttl', help='Minutes that KPI definitions, campaigns and the ID of the traits.email attribute are re-used by the jobs (default: 60)', type=float, default=60)
+argParser.add_argument('--host', help='Address the health and metrics endpoints listen on (default: 127.0.0.1)', default='127.0.0.1')
+argParser.add_argument('--port', help='Port of the health and metrics endpoints, 0 disables them (default: 9464)', type=int, default=9464)
+args = argParser.parse_args()
+
+# The jobs of the daemon, the command line of each job is parsed again for every run (so e.g. yesterday is always the day before the run)
+JOBS = []
+for name, script, interval, jobArgs in [('fetchMessageStatistcs', fetchMessageStatistcs, args.statistics_interval, args.statistics_args), ('optOutSendgridGlobalSuppressions', optOutSendgridGlobalSuppressions, args.suppressions_interval, args.suppressions_args)]:
+    if interval > 0:
+        argv = shlex.split(jobArgs)
+        script.parseArguments(argv) # Fail now if the command line is invalid
+        JOBS.append({'name': name, 'script': script, 'argv': argv, 'interval': interval * 60, 'running': False, 'runs': 0, 'failures': 0, 'lastRun': None, 'nextRunAt': time.time(), 'report': None})
+if not JOBS:
+    argParser.error('all jobs are disabled')
+for job in JOBS:
+    print('Job:', job['name'], 'every', job['interval'] / 60, 'minutes with arguments', job['argv'])
+
+# Load environment variables
+dotenv.load_dotenv()
+API_KEY = os.getenv('XNG_MASTER_API_KEY')
+XNG_USER = os.getenv('XNG_APP_USER')
+XNG_PASS = os.getenv('XNG_APP_PASSWORD')
+print('API key (last 3 characters):', API_KEY[-3:])
+print('Username:', XNG_USER)
+
+# Configuration
+TIMEOUT = 60
+POOL_SIZE = 32 # Both jobs run concurrently on the same connection pool
+
+# One client for all runs: its connections stay open and its login is re-used until the token expires.
+# Its requests are recorded by metrics, which counts them over the lifetime of the daemon.
+metrics = requestMetrics.RequestMetrics('daemon')
+client = crossengageClient.CrossEngageClient(API_KEY, XNG_USER, XNG_PASS, apiVersion=2, poolSize=POOL_SIZE, timeout=TIMEOUT, metrics=metrics)
+metadata = metadataCache.MetadataCache(ttl=args.metadata_ttl * 60)
+jobsLock = threading.Lock()
+stopping = threading.Event()
+
+# Run a job every interval (measured from the start of the previous run) until the daemon stops.
+# The run level values of each run (rows written, users opted out, success, ...) are kept until the next run.
+def runJob(job):
+    while not stopping.wait(max(0, job['nextRunAt'] - time.time())):
+        runMetrics = requestMetrics.RequestMetrics(job['name'])
+        with jobsLock:
+            job['running'] = True
+            job['nextRunAt'] = time.time() + job['interval']
+        print('Starting', job['name'])
+        try:
+            exitCode = job['script'].run(job['script'].parseArguments(job['argv']), client=client, metadata=metadata, metrics=runMetrics)
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            exitCode = 1
+        if exitCode:
+            metadata.invalidate() # Do not keep metadata that may be the cause of the failure
+        print('Finished', job['name'], 'with exit code', exitCode, 'after', round(time.time() - runMetrics.startedAt, 1), 'seconds')
+        with jobsLock:
+            job['running'] = False
+            job['runs'] += 1
+            job['failures'] += 1 if exitCode else 0
+            job['lastRun'] = {'startedAt': int(runMetrics.startedAt), 'durationSeconds': round(time.time() - runMetrics.startedAt, 3), 'exitCode': exitCode}
+            job['report'] = runMetrics.report()
+
+def health():
+    with jobsLock:
+        jobs = [{
+            'job': job['name'],
+            'running': job['running'],
+            'runs': job['runs'],
+            'failures': job['failures'],
+            'lastRun': job['lastRun'],
+            'nextRunAt': datetime.datetime.fromtimestamp(job['nextRunAt'], datetime.timezone.utc).isoformat()
+        } for job in JOBS]
+    return {'healthy': all(job['lastRun'] is None or job['lastRun']['exitCode'] == 0 for job in jobs), 'jobs': jobs}
+
+# GET /health answers 200 if the last run of every job succeeded and 503 otherwise,
+# GET /metrics the request metrics of the daemon and the run level values of the last run of each job
+class StatusHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/health':
+            status = health()
+            self.respond(200 if status['healthy'] else 503, 'application/json', json.dumps(status, indent=2))
+        elif self.path == '/metrics':
+            with jobsLock:
+                reports = [metrics.report()] + [job['report'] for job in JOBS if job['report']]
+            self.respond(200, 'text/plain; version=0.0.4', requestMetrics.prometheusText(reports))
+        else:
+            self.respond(404, 'text/plain', 'Not found\n')
+
+    def respond(self, status, contentType, text):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *logArgs):
+        pass
+
+server = None
+if args.port:
+    server = http.server.ThreadingHTTPServer((args.host, args.port), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Serving /health and /metrics on', 'http://' + args.host + ':' + str(server.server_address[1]))
+
+# Stop on SIGINT or SIGTERM once the running jobs are finished (the journal of the opt-out sync allows to --resume a killed run)
+def stop(signum, frame):
+    if not stopping.is_set():
+        print('Stopping after the running jobs are finished')
+        stopping.set()
+signal.signal(signal.SIGINT, stop)
+signal.signal(signal.SIGTERM, stop)
+
+jobThreads = [threading.Thread(target=runJob, args=(job,)) for job in JOBS]
+for thread in jobThreads:
+    thread.start()
+while any(thread.is_alive() for thread in jobThreads):
+    for thread in jobThreads:
+        thread.join(1)
+if server:
+    server.shutdown()
+print('Stopped')
+sys.exit(0 if health()['healthy'] else 1)
@@ -0,0 +1,79 @@
+# Compact set of email addresses for suppression lists with millions of entries, compared by their normalized
+# (stripped and lower case) form. Instead of keeping the email strings in memory, each normalized address is reduced
+# to a 64-bit digest stored in an open-addressing hash table (a flat array of unsigned 64-bit integers, 16 to 32 bytes
+# per address), and every new address is appended to a temporary file from which it is read back when iterating.
+# The file keeps the first seen spelling of each address (only stripped), as CrossEngage may compare it case-sensitively.
+# Two different addresses sharing a digest are practically impossible (about 1 in 400000 for 10 million addresses).
+
+import array, hashlib, tempfile
+
+INITIAL_CAPACITY = 1024 # Number of slots, always a power of two
+MAX_LOAD_FACTOR = 0.5
+READ_BLOCK_SIZE = 1 << 16
+
+def normalizeEmail(email):
+    return email.strip().lower()
+
+def emailDigest(email):
+    return int.from_bytes(hashlib.blake2b(email.encode('utf-8'), digest_size=8).digest(), 'little') or 1 # 0 marks empty slots
+
+class EmailSet:
+    def __init__(self):
+        self.slots = array.array('Q', bytes(8 * INITIAL_CAPACITY))
+        self.mask = INITIAL_CAPACITY - 1
+        self.count = 0
+        self.spillFile = tempfile.TemporaryFile()
+
+    # Find the slot of a digest with linear probing, which is either the slot holding it or the empty slot for it
+    def findSlot(self, digest):
+        slots, mask = self.slots, self.mask
+        i = digest & mask
+        while slots[i] and slots[i] != digest:
+            i = (i + 1) & mask
+        return i
+
+    # Add an email address, returns False if it is empty (or contains a line break) or already in the set
+    def add(self, email):
+        email = email.strip()
+        if not email or '\n' in email:
+            return False
+        digest = emailDigest(normalizeEmail(email))
+        i = self.findSlot(digest)
+        if self.slots[i]:
+            return False
+        self.slots[i] = digest
+        self.count += 1
+        self.spillFile.write(email.encode('utf-8') + b'\n')
+        if self.count > MAX_LOAD_FACTOR * len(self.slots):
+            self.grow()
+        return True
+
+    def grow(self):
+        oldSlots = self.slots
+        self.slots = array.array('Q', bytes(16 * len(oldSlots)))
+        self.mask = len(self.slots) - 1
+        for digest in oldSlots:
+            if digest:
+                self.slots[self.findSlot(digest)] = digest
+
+    def __contains__(self, email):
+        return bool(self.slots[self.findSlot(emailDigest(normalizeEmail(email)))])
+
+    def __len__(self):
+        return self.count
+
+    # Yield the email addresses in the order they were added, reading the temporary file block by block
+    def __iter__(self):
+        position = 0
+        while True:
+            self.spillFile.seek(position)
+            lines = self.spillFile.readlines(READ_BLOCK_SIZE)
+            if not lines:
+                return
+            position = self.spillFile.tell()
+            self.spillFile.seek(0, 2) # Addresses added while iterating are appended at the end
+            for line in lines:
+                yield line[:-1].decode('utf-8')
+
+    def close(self):
+        self.spillFile.close()
@@ -1,187 +1,182 @@
 #!/usr/bin/env python3
 
-import argparse, dotenv, os, datetime, traceback, sys, json, requests, csv
+import argparse, dotenv, os, datetime, traceback, sys, json, collections, concurrent.futures
+import atexit, crossengageClient, lineOutput, metadataCache, requestMetrics, responseCache, statisticsTransform, statisticsWriters
 
 # Parsing command line arguments
-argParser = argparse.ArgumentParser(description='Generates a CSV file with yesterday\'s message statistics for campaigns in your account')
-argParser.add_argument('target', help='Write the result into csv file specified through this argument. Example: output.csv')
+def parseDate(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid date ' + value + ', expected format YYYY-MM-DD')
+argParser = argparse.ArgumentParser(description='Generates a CSV, Parquet or Arrow file with message statistics (by default yesterday\'s) for campaigns in your account')
+argParser.add_argument('target', help='Write the result into the file specified through this argument. Example: output.csv')
 argParser.add_argument('-r', '--reduced', help='Use a more compact output format with only one row per campaign message and separate columns for each KPI', action='store_true')
-args = argParser.parse_args()
-TARGET_FILE = args.target
-print('Target File:', TARGET_FILE)
-
-# Load environment variables
-dotenv.load_dotenv()
-API_KEY = os.getenv('XNG_MASTER_API_KEY')
-XNG_USER = os.getenv('XNG_APP_USER')
-XNG_PASS = os.getenv('XNG_APP_PASSWORD')
-print('API key (last 3 characters):', API_KEY[-3:])
-print('Username:', XNG_USER)
+argParser.add_argument('-f', '--format', help='Format of the target file (default: csv). Parquet and Arrow IPC files are typed and dictionary encoded and require pyarrow', choices=statisticsWriters.FORMATS, default='csv')
+argParser.add_argument('-z', '--gzip', help='Compress the csv file with gzip (implied if the target file ends with .gz)', action='store_true')
+argParser.add_argument('-w', '--workers', help='Number of campaigns to fetch statistics for concurrently (default: 1)', type=int, default=1)
+argParser.add_argument('-s', '--start', help='First day to fetch statistics for, as YYYY-MM-DD (default: yesterday)', type=parseDate)
+argParser.add_argument('-e', '--end', help='Last day to fetch statistics for, as YYYY-MM-DD (default: yesterday)', type=parseDate)
+argParser.add_argument('--cache-dir', help='Directory for cached statistics of past days (default: .statistics-cache)', default='.statistics-cache')
+argParser.add_argument('--no-cache', help='Neither read nor write cached statistics', action='store_true')
+argParser.add_argument('-m', '--metrics', help='Write per-endpoint request metrics into this file at the end of the run, in the Prometheus textfile format if it ends with .prom and as JSON otherwise')
 
-# Configuration
-TIMEOUT = 60
-KPIS_TO_EXPORT = ['Sent', 'Delivered', 'Viewed', 'Clicked', 'Unique Viewed', 'Unique Clicked', 'Soft Bounced', 'Hard Bounced', 'Marked as Spam', 'Unsubscribed']
-START_DATE = (datetime.datetime.now() - datetime.timedelta(1)).strftime('%Y-%m-%d')
-END_DATE = (datetime.datetime.now() - datetime.timedelta(1)).strftime('%Y-%m-%d')
-print('Fetching statistics from', START_DATE, 'to', END_DATE)
+# Parse the command line (or the given list of arguments), the dates default to yesterday at the time of the call
+def parseArguments(argv=None):
+    args = argParser.parse_args(argv)
+    yesterday = (datetime.datetime.now() - datetime.timedelta(1)).date()
+    args.start = args.start or yesterday
+    args.end = args.end or yesterday
+    if args.start > args.end:
+        argParser.error('the start date must not be after the end date')
+    return args
 
-# Create re-usable session
-session = requests.Session()
-retries = requests.adapters.HTTPAdapter(max_retries=3)
-session.mount('https://', retries)
-API_BASE_URL = 'https://api.crossengage.io'
-UI_BASE_URL = 'https://ui-api.crossengage.io/ui'
+# Export the statistics. client, metadata (a metadataCache.MetadataCache) and metrics can be shared with other jobs,
+# e.g. by daemon.py, otherwise they are created for this run. Returns the exit code.
+def run(args, client=None, metadata=None, metrics=None):
+    metadata = metadata or metadataCache.MetadataCache()
+    TARGET_FILE = args.target
+    WORKERS = max(1, args.workers)
+    FORMAT = args.format
+    COMPRESS = FORMAT == 'csv' and (args.gzip or TARGET_FILE.endswith('.gz'))
+    print('Target File:', TARGET_FILE, '(' + FORMAT + (', gzip compressed' if COMPRESS else '') + ')')
+    print('Workers:', WORKERS)
 
-# Identify the company ID
-companyIdurl = UI_BASE_URL + '/managers/companies'
-companyIdPayload = {
-    'email': XNG_USER
-}
-try:
-    companyIdResponse = session.post(companyIdurl, data=json.dumps(companyIdPayload), timeout=TIMEOUT)
-    if companyIdResponse.status_code == 200:
-        companyIds = json.loads(companyIdResponse.text)
-        if len(companyIds) != 1:
-            raise ValueError('Unexpected number of company IDs returned: ' + companyIdResponse.text)
-        else:
-            companyId = companyIds[0]
-            print('Found company ID', companyId)
-    else:
-        raise ValueError('Unexpected response code ' + str(companyIdResponse.status_code) + ' when fetching company ID')
-except Exception:
-    print('Fetching company ID failed')
-    traceback.print_exc()
-    sys.exit(1)
+    # Load environment variables
+    dotenv.load_dotenv()
+    API_KEY = os.getenv('XNG_MASTER_API_KEY')
+    XNG_USER = os.getenv('XNG_APP_USER')
+    XNG_PASS = os.getenv('XNG_APP_PASSWORD')
+    print('API key (last 3 characters):', API_KEY[-3:])
+    print('Username:', XNG_USER)
 
-# Getting UI API token
-uiTokenUrl = UI_BASE_URL + '/managers/login'
-uiTokenPayload = {
-    "email": XNG_USER,
-    "password": XNG_PASS
-}
-uiTokenHeaders = {
-    'content-type': 'application/json',
-    'company-id': str(companyId)
-}
-try:
-    uiTokenResponse = session.post(uiTokenUrl, data=json.dumps(uiTokenPayload), headers=uiTokenHeaders, timeout=TIMEOUT)
-    if uiTokenResponse.status_code == 200:
-        uiToken = json.loads(uiTokenResponse.text)['token']
-        print('Retrieved UI token (last 5 characters):', uiToken[-5:])
-    else:
-        raise ValueError('Unexpected response code ' + str(uiTokenResponse.status_code) + ' when fetching UI token')
-except Exception:
-    print('Fetching UI token failed')
-    traceback.print_exc()
-    sys.exit(1)
+    # Configuration
+    TIMEOUT = 60
+    KPIS_TO_EXPORT = ['Sent', 'Delivered', 'Viewed', 'Clicked', 'Unique Viewed', 'Unique Clicked', 'Soft Bounced', 'Hard Bounced', 'Marked as Spam', 'Unsubscribed']
+    START_DATE = args.start.strftime('%Y-%m-%d')
+    END_DATE = args.end.strftime('%Y-%m-%d')
+    DAYS = [(args.start + datetime.timedelta(i)).strftime('%Y-%m-%d') for i in range((args.end - args.start).days + 1)]
+    print('Fetching statistics from', START_DATE, 'to', END_DATE, '(' + str(len(DAYS)), 'days)')
 
-# Defining Headers
-API_HEADERS = {
-    'Content-Type': 'application/json',
-    'X-XNG-ApiVersion': str(2),
-    'X-XNG-AuthToken': API_KEY
-}
-UI_HEADERS = {
-    'Accept': 'application/json',
-    'Content-Type': 'application/json',
-    'Company-ID': str(companyId),
-    'X-XNG-ApiVersion': str(2),
-    'Authorization': 'Bearer ' + uiToken
-}
+    # Statistics of days that have ended (in UTC, which the statistics API uses) do not change anymore and are cached
+    CACHE = None if args.no_cache else responseCache.ResponseCache(args.cache_dir)
+    FIRST_OPEN_DAY = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
+    if CACHE:
+        print('Cache Directory:', args.cache_dir)
 
-# Fetch KPI definitions
-kpiDefinitionsUrl = API_BASE_URL + '/statistics/kpi'
-try:
-    metricsResponse = session.get(kpiDefinitionsUrl, headers=API_HEADERS, timeout=TIMEOUT)
-    if metricsResponse.status_code == 200:
-        kpiDefinitions = json.loads(metricsResponse.text)
-        print('Retrieved KPI definitions')
-    else:
-        raise ValueError('Unexpected response code ' + str(metricsResponse.status_code) + ' when fetching KPI definitions')
-except Exception:
-    print('Fetching KPI definitions failed')
-    traceback.print_exc()
-    sys.exit(1)
+    # Record request metrics if requested, the report is also written if the run fails
+    if metrics is None and args.metrics:
+        metrics = requestMetrics.RequestMetrics('fetchMessageStatistcs')
+        atexit.register(metrics.writeReport, args.metrics)
 
-# Fetch campaigns
-campaignsUrl = UI_BASE_URL + '/campaigns'
-try:
-    campaignsResponse = session.get(campaignsUrl, headers=UI_HEADERS, timeout=TIMEOUT)
-    if campaignsResponse.status_code == 200:
-        campaigns = json.loads(campaignsResponse.text)
-        print('Fetched', str(len(campaigns)), 'campaigns')
-    else:
-        raise ValueError('Unexpected response code ' + str(campaignsResponse.status_code) + ' when fetching campaigns')
-except Exception:
-    print('Fetching campaigns failed')
-    traceback.print_exc()
-    sys.exit(1)
+    # Create re-usable client with one pooled connection per worker (unless one is passed in) and log in (or re-use the cached login)
+    if client is None:
+        client = crossengageClient.CrossEngageClient(API_KEY, XNG_USER, XNG_PASS, apiVersion=2, poolSize=WORKERS, timeout=TIMEOUT, metrics=metrics)
+    try:
+        client.login()
+    except Exception:
+        print('Logging in failed')
+        traceback.print_exc()
+        return 1
 
-# Fetch message statistics for each campaign and build list
-results = []
-for campaign in campaigns:
-    print('Fetching statistics for campaign', campaign['id'])
-    campaignStatisticsUrl = UI_BASE_URL + '/campaign/' + str(campaign['id']) + '/stats?startDate=' + START_DATE + 'T00:00:00.000Z&endDate=' + END_DATE + 'T23:59:59.999Z&groupBy=MESSAGE&interval=DAY'
+    # Fetch KPI definitions (or take them from the metadata cache)
+    def fetchKpiDefinitions():
+        metricsResponse = client.api('GET', '/statistics/kpi', apiVersion=2)
+        if metricsResponse.status_code == 200:
+            print('Retrieved KPI definitions')
+            return json.loads(metricsResponse.text)
+        else:
+            raise ValueError('Unexpected response code ' + str(metricsResponse.status_code) + ' when fetching KPI definitions')
     try:
-        campaignStatisticsResponse = session.get(campaignStatisticsUrl, headers=UI_HEADERS, timeout=TIMEOUT)
-        if campaignStatisticsResponse.status_code == 200:
-            campaignStatistics = json.loads(campaignStatisticsResponse.text)
-            print('Received statistics for campaign', campaign['id'])
-            for day in campaignStatistics['history']:
-                date = day[:10]
-                for messageStatistic in campaignStatistics['history'][day]:
-                    messageId = messageStatistic['id']
-                    messageDetails = campaignStatistics['description'][messageId]
-                    if args.reduced:
-                        result = {
-                            'Date': date,
-                            'Campaign ID': campaign['id'],
-                            'Campaign Name': campaign['name'],
-                            'Message ID': messageId,
-                            'Message Name': messageDetails['name'],
-                            'Message Channel': messageDetails['channelType']
-                        }
-                        for kpiId in messageStatistic['values']:
-                            value = messageStatistic['values'][kpiId]
-                            if len([kpi for kpi in kpiDefinitions if str(kpi['id']) == kpiId]) == 1: # Check if the ID belongs to a defined KPI
-                                currentKpi = [kpi for kpi in kpiDefinitions if str(kpi['id']) == kpiId][0]
-                                if currentKpi['name'] in KPIS_TO_EXPORT: # Check if the KPI is one of the KPIs we want to export
-                                    result[currentKpi['name']] = value
-                        results.append(result)
-                    else:
-                        for kpiId in messageStatistic['values']:
-                            value = messageStatistic['values'][kpiId]
-                            if len([kpi for kpi in kpiDefinitions if str(kpi['id']) == kpiId]) == 1: # Check if the ID belongs to a defined KPI
-                                currentKpi = [kpi for kpi in kpiDefinitions if str(kpi['id']) == kpiId][0]
-                                if currentKpi['name'] in KPIS_TO_EXPORT: # Check if the KPI is one of the KPIs we want to export
-                                    result = {
-                                        'Date': date,
-                                        'Campaign ID': campaign['id'],
-                                        'Campaign Name': campaign['name'],
-                                        'Message ID': messageId,
-                                        'Message Name': messageDetails['name'],
-                                        'Message Channel': messageDetails['channelType'],
-                                        'KPI': currentKpi['name'],
-                                        'Value': value
-                                    }
-                                    results.append(result)
+        kpiDefinitions = metadata.get('kpiDefinitions', fetchKpiDefinitions)
+    except Exception:
+        print('Fetching KPI definitions failed')
+        traceback.print_exc()
+        return 1
+
+    # Fetch campaigns (or take them from the metadata cache)
+    def fetchCampaigns():
+        campaignsResponse = client.ui('GET', '/campaigns')
+        if campaignsResponse.status_code == 200:
+            campaigns = json.loads(campaignsResponse.text)
+            print('Fetched', str(len(campaigns)), 'campaigns')
+            return campaigns
         else:
-            raise ValueError('Unexpected response code ' + str(campaignStatisticsResponse.status_code) + ' when fetching campaign statistics')
+            raise ValueError('Unexpected response code ' + str(campaignsResponse.status_code) + ' when fetching campaigns')
+    try:
+        campaigns = metadata.get('campaigns', fetchCampaigns)
+    except Exception:
+        print('Fetching campaigns failed')
+        traceback.print_exc()
+        return 1
+
+    # Fetch message statistics for a single campaign and day and turn them into rows (runs in a worker thread).
+    # The response is decoded while it streams in, so neither its body nor its text are kept in memory.
+    # All rows of the campaign and day are collected though, as they are written in campaign and day order.
+    def fetchCampaignRows(campaign, day):
+        cacheable = CACHE is not None and day < FIRST_OPEN_DAY
+        if cacheable:
+            cachedStatistics = CACHE.openEntry(client.companyId, campaign['id'], day)
+            if cachedStatistics is not None:
+                print('Using cached statistics for campaign', campaign['id'], 'on', day)
+                with cachedStatistics:
+                    return list(statisticsTransform.buildRowsFromHistory(campaign, statisticsTransform.iterStatistics(cachedStatistics), kpiIndex, args.reduced))
+        print('Fetching statistics for campaign', campaign['id'], 'on', day)
+        campaignStatisticsPath = '/campaign/' + str(campaign['id']) + '/stats?startDate=' + day + 'T00:00:00.000Z&endDate=' + day + 'T23:59:59.999Z&groupBy=MESSAGE&interval=DAY'
+        with client.ui('GET', campaignStatisticsPath, stream=True) as campaignStatisticsResponse:
+            if campaignStatisticsResponse.status_code != 200:
+                raise ValueError('Unexpected response code ' + str(campaignStatisticsResponse.status_code) + ' when fetching statistics for campaign ' + str(campaign['id']) + ' on ' + day)
+            campaignStatisticsResponse.raw.decode_content = True
+            if cacheable:
+                with CACHE.newEntry(client.companyId, campaign['id'], day) as cacheFile:
+                    rows = list(statisticsTransform.buildRowsFromHistory(campaign, statisticsTransform.iterStatistics(responseCache.TeeReader(campaignStatisticsResponse.raw, cacheFile)), kpiIndex, args.reduced))
+            else:
+                rows = list(statisticsTransform.buildRowsFromHistory(campaign, statisticsTransform.iterStatistics(campaignStatisticsResponse.raw), kpiIndex, args.reduced))
+        print('Received statistics for campaign', campaign['id'], 'on', day)
+        return rows
+
+    # Fetch statistics for all campaigns and days concurrently but yield them in campaign and day order,
+    # keeping at most two requests per worker in flight so finished responses do not pile up
+    def fetchAllCampaignRows(campaigns):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            pending = collections.deque()
+            for campaign in campaigns:
+                for day in DAYS:
+                    pending.append((campaign, day, executor.submit(fetchCampaignRows, campaign, day)))
+                    if len(pending) >= 2 * WORKERS:
+                        pendingCampaign, pendingDay, future = pending.popleft()
+                        yield pendingCampaign, pendingDay, future.result()
+            while pending:
+                pendingCampaign, pendingDay, future = pending.popleft()
+                yield pendingCampaign, pendingDay, future.result()
+
+    # Fetch message statistics for each campaign and write the rows into the target file as soon as they arrive
+    kpiIndex = statisticsTransform.buildKpiIndex(kpiDefinitions, KPIS_TO_EXPORT)
+    print('JSON decoding:', statisticsTransform.JSON_BACKEND)
+    try:
+        writer = statisticsWriters.openWriter(TARGET_FILE, statisticsTransform.getFields(args.reduced, KPIS_TO_EXPORT), FORMAT, COMPRESS)
+    except Exception:
+        print('Opening target file failed')
+        traceback.print_exc()
+        return 1
+    try:
+        for campaign, day, rows in fetchAllCampaignRows(campaigns):
+            writer.writeRows(rows)
+            print('Wrote statistics for campaign', campaign['id'], 'on', day, 'to file')
+            if metrics:
+                metrics.addValue('campaign_days')
+                metrics.addValue('rows_written', len(rows))
     except Exception:
-        print('Fetching campaign statistics failed')
+        print('Fetching campaign statistics failed, the file only contains the campaigns written so far')
         traceback.print_exc()
-        sys.exit(1)
+        return 1
+    finally:
+        writer.close()
+    if metrics:
+        metrics.setValue('success', 1)
+    print('Finished')
+    return 0
 
-# Now write everything into a csv file
-print('Writing statistics to file')
-with open(TARGET_FILE, 'w+', newline='', encoding='utf-8') as csvfile:
-    fields = ['Date', 'Campaign ID', 'Campaign Name', 'Message ID', 'Message Name', 'Message Channel']
-    if args.reduced:
-        fields.extend(KPIS_TO_EXPORT)
-    else:
-        fields.extend(['KPI', 'Value'])
-    writer = csv.DictWriter(csvfile, fieldnames=fields)
-    writer.writeheader()
-    for result in results:
-        writer.writerow(result)
-print('Finished')
+if __name__ == '__main__':
+    lineOutput.install()
+    sys.exit(run(parseArguments()))
@@ -0,0 +1,38 @@
+# Standard output and error shared by worker threads (and by the jobs of daemon.py) without fragmented lines.
+# print() writes its values, the separators and the line end one at a time, so lines printed by concurrent
+# threads could be cut into each other. install() wraps both streams so that the text written by each thread
+# is collected until the end of a line and then written as a whole.
+
+import sys, threading
+
+class LineOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.RLock() # Re-entrant, as a signal handler printing on the main thread may interrupt a write
+        self.local = threading.local() # Text of the current thread since its last complete line
+
+    def write(self, text):
+        pending = getattr(self.local, 'pending', '') + text
+        end = pending.rfind('\n') + 1
+        if end:
+            with self.lock:
+                self.stream.write(pending[:end])
+        self.local.pending = pending[end:]
+        return len(text)
+
+    def flush(self):
+        pending = getattr(self.local, 'pending', '')
+        self.local.pending = ''
+        with self.lock:
+            if pending:
+                self.stream.write(pending)
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def install():
+    if not isinstance(sys.stdout, LineOutput):
+        sys.stdout = LineOutput(sys.stdout)
+    if not isinstance(sys.stderr, LineOutput):
+        sys.stderr = LineOutput(sys.stderr)
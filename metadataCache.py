@@ -0,0 +1,30 @@
+# In-memory cache for metadata that rarely changes (KPI definitions, campaigns, the ID of the traits.email attribute),
+# so the jobs of daemon.py do not fetch it again on every run. Entries expire after the TTL in seconds and are loaded
+# again by the next get(). With the default TTL of 0 nothing is cached, which is what the scripts use when run on their own.
+
+import threading, time
+
+class MetadataCache:
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {} # Key -> (loaded at, value)
+
+    # Return the cached value for the key, or call load() and cache its result if there is none or it expired
+    def get(self, key, load):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            return entry[1]
+        value = load()
+        if self.ttl > 0:
+            with self.lock:
+                self.entries[key] = (time.monotonic(), value)
+        return value
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
@@ -1,289 +1,568 @@
 #!/usr/bin/env python3
 
-import dotenv, os, datetime, time, traceback, sys, json, requests, uuid
-
-# Load environment variables
-dotenv.load_dotenv()
-API_KEY = os.getenv('XNG_MASTER_API_KEY')
-XNG_USER = os.getenv('XNG_APP_USER')
-XNG_PASS = os.getenv('XNG_APP_PASSWORD')
-WEB_TRACKING_KEY = os.getenv('XNG_WEB_TRACKING_KEY')
-SG_KEY = os.getenv('SENDGRID_API_KEY')
-print('CrossEngage API key (last 3 characters):', API_KEY[-3:])
-print('CrossEngage User:', XNG_USER)
-print('Sendgrid API Key (last 3 characters):', SG_KEY[-3:])
-
-# Configuration
-TIMEOUT = 60
-MAX_USERS_PER_SEGMENT = 100
-
-# Create re-usable session
-session = requests.Session()
-retries = requests.adapters.HTTPAdapter(max_retries=3)
-session.mount('https://', retries)
-API_BASE_URL = 'https://api.crossengage.io'
-UI_BASE_URL = 'https://ui-api.crossengage.io/ui'
-SENDGRID_API_BASE_URL = 'https://api.sendgrid.com/v3'
-
-# Sendgrid API Headers
-SENDGRID_API_HEADERS = {
-    'Content-Type': 'application/json',
-    'Authorization': 'Bearer ' + SG_KEY
-}
-
-# Fetch global unsubscribes (paginated, Sendgrid only provides a maximum of 500 entries per request)
-SENDGRID_UNSUBSCRIBES = []
-globalUnsubscribesUrl = SENDGRID_API_BASE_URL + '/suppression/unsubscribes?limit=500&offset=0'
-moreUnsubscribes = True
-while moreUnsubscribes == True:
+import argparse, atexit, contextlib, dotenv, os, datetime, time, traceback, sys, json, uuid, itertools, threading, concurrent.futures
+import crossengageClient, emailSet, lineOutput, metadataCache, optOutStore, rateLimiter, requestMetrics, retryQueue, runJournal
+
+# Parsing command line arguments
+def parseRate(value):
     try:
-        globalUnsubscribesResponse = session.get(globalUnsubscribesUrl, headers=SENDGRID_API_HEADERS, timeout=TIMEOUT)
+        rate = float(value)
+    except ValueError:
+        rate = 0
+    if not rate > 0:
+        raise argparse.ArgumentTypeError('invalid rate ' + value + ', expected a number of requests per second greater than 0')
+    return rate
+argParser = argparse.ArgumentParser(description='Opts out CrossEngage users whose email addresses are on the Global Unsubscribes list in Sendgrid')
+argParser.add_argument('--sendgrid-workers', help='Number of pages of global unsubscribes to download from Sendgrid concurrently (default: 4)', type=int, default=4)
+argParser.add_argument('--sendgrid-rate', help='Maximum number of requests per second to the Sendgrid API (default: 10)', type=parseRate, default=10)
+argParser.add_argument('--state-file', help='File keeping the watermark of the last successful run for incremental syncs (default: .sendgrid-sync-state.json)', default='.sendgrid-sync-state.json')
+argParser.add_argument('--full', help='Process all global unsubscribes instead of only those created since the last successful run', action='store_true')
+argParser.add_argument('--full-every', help='Process all global unsubscribes if the last full run is older than this many days (default: never)', type=float)
+argParser.add_argument('--max-users-per-segment', help='Maximum number of email addresses matched by one segment (default: 5000)', type=int, default=5000)
+argParser.add_argument('--max-segment-bytes', help='Maximum size of the JSON payload creating a segment, segments are made smaller to stay within it (default: 262144)', type=int, default=262144)
+argParser.add_argument('--segments-in-flight', help='Number of segments processed concurrently, each from creation to deletion (default: 4)', type=int, default=4)
+argParser.add_argument('--user-workers', help='Number of users whose opt-out status is checked and updated concurrently (default: 8)', type=int, default=8)
+argParser.add_argument('--rate', help='Maximum number of requests per second to CrossEngage for checking and updating the opt-out status of users (default: 20)', type=parseRate, default=20)
+argParser.add_argument('--store', help='SQLite database remembering users confirmed as opted out, so they are not checked again (default: .sendgrid-opt-outs.sqlite)', default='.sendgrid-opt-outs.sqlite')
+argParser.add_argument('--no-store', help='Neither use nor update the database of users confirmed as opted out', action='store_true')
+argParser.add_argument('--revalidate-days', help='Check users confirmed as opted out again once their confirmation is older than this many days (default: 30)', type=float, default=30)
+argParser.add_argument('--journal', help='File recording the progress of the run, so an interrupted run can be resumed (default: .sendgrid-sync-journal.jsonl)', default='.sendgrid-sync-journal.jsonl')
+argParser.add_argument('--resume', help='Resume the interrupted run recorded in the journal, skipping the email addresses it already processed', action='store_true')
+argParser.add_argument('--retries', help='Number of times a user or segment that failed is retried, with exponential backoff, before it is written to the dead-letter file (default: 3)', type=int, default=3)
+argParser.add_argument('--dead-letters', help='File collecting the users and segments that still failed after all retries (default: .sendgrid-sync-dead-letters.jsonl)', default='.sendgrid-sync-dead-letters.jsonl')
+argParser.add_argument('--replay', help='Only process the users and segments in the dead-letter file again instead of the global unsubscribes from Sendgrid', action='store_true')
+argParser.add_argument('-m', '--metrics', help='Write per-endpoint request metrics into this file at the end of the run, in the Prometheus textfile format if it ends with .prom and as JSON otherwise')
+
+# Parse the command line (or the given list of arguments)
+def parseArguments(argv=None):
+    args = argParser.parse_args(argv)
+    if args.replay and args.resume:
+        argParser.error('--replay can not be combined with --resume')
+    return args
+
+# Sync the opt-outs, the files and threads of the run are registered with cleanup and closed once it returns
+def syncOptOuts(args, client, metadata, metrics, cleanup):
+    # Load environment variables
+    dotenv.load_dotenv()
+    API_KEY = os.getenv('XNG_MASTER_API_KEY')
+    XNG_USER = os.getenv('XNG_APP_USER')
+    XNG_PASS = os.getenv('XNG_APP_PASSWORD')
+    WEB_TRACKING_KEY = os.getenv('XNG_WEB_TRACKING_KEY')
+    SG_KEY = os.getenv('SENDGRID_API_KEY')
+    print('CrossEngage API key (last 3 characters):', API_KEY[-3:])
+    print('CrossEngage User:', XNG_USER)
+    print('Sendgrid API Key (last 3 characters):', SG_KEY[-3:])
+
+    # Configuration
+    TIMEOUT = 60
+    MAX_USERS_PER_SEGMENT = max(1, args.max_users_per_segment)
+    MAX_SEGMENT_BYTES = args.max_segment_bytes
+    USER_EXPLORER_PAGE_SIZE = 1000
+    SENDGRID_PAGE_SIZE = 500 # Sendgrid only provides a maximum of 500 entries per request
+    SENDGRID_WORKERS = max(1, args.sendgrid_workers)
+    SEGMENTS_IN_FLIGHT = max(1, args.segments_in_flight)
+    USER_WORKERS = max(1, args.user_workers)
+    RETRY_WORKERS = 4
+
+    # Record request metrics if requested, the report is also written if the run fails
+    if metrics is None and args.metrics:
+        metrics = requestMetrics.RequestMetrics('optOutSendgridGlobalSuppressions')
+        atexit.register(metrics.writeReport, args.metrics)
+
+    # Create re-usable client unless one is passed in (its session is also used for the Sendgrid API)
+    if client is None:
+        client = crossengageClient.CrossEngageClient(API_KEY, XNG_USER, XNG_PASS, apiVersion=1, poolSize=max(10, SENDGRID_WORKERS, SEGMENTS_IN_FLIGHT + USER_WORKERS + RETRY_WORKERS), timeout=TIMEOUT, metrics=metrics)
+    session = client.session
+    SENDGRID_API_BASE_URL = os.getenv('SENDGRID_API_BASE_URL', 'https://api.sendgrid.com/v3')
+    TRACKING_BASE_URL = os.getenv('XNG_TRACKING_BASE_URL', 'https://trk-api.crossengage.io')
+
+    # Sendgrid API Headers
+    SENDGRID_API_HEADERS = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + SG_KEY
+    }
+
+    # Decide between a full and an incremental sync. An incremental sync only requests global unsubscribes
+    # created since the watermark (the latest creation timestamp seen by the last successful run).
+    # All runs only request entries created before the start of the run, so concurrent pages stay consistent.
+    def readSyncState():
+        try:
+            with open(args.state_file, 'r', encoding='utf-8') as stateFile:
+                return json.load(stateFile)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            print('Ignoring unreadable state file', args.state_file)
+            return {}
+
+    def writeSyncState(state):
+        temporaryFile = args.state_file + '.tmp'
+        with open(temporaryFile, 'w', encoding='utf-8') as stateFile:
+            json.dump(state, stateFile, indent=2)
+        os.replace(temporaryFile, args.state_file)
+
+    SYNC_STATE = readSyncState()
+
+    # A resumed run requests the same time window from Sendgrid as the interrupted run recorded in the journal
+    previousRun = runJournal.readJournal(args.journal, resume=args.resume)
+    if previousRun and previousRun.completedEmails is not None:
+        cleanup.callback(previousRun.completedEmails.close)
+    resuming = args.resume and previousRun is not None and previousRun.run is not None and not previousRun.finished
+    if args.resume and not resuming:
+        print('Found no interrupted run to resume in', args.journal)
+    if args.replay:
+        RUN_STARTED_AT = int(time.time())
+        fullSync = False
+        startTime = None
+        print('Replaying the users and segments in', args.dead_letters)
+    elif resuming:
+        RUN_STARTED_AT = previousRun.run['runStartedAt']
+        fullSync = previousRun.run['fullSync']
+        startTime = previousRun.run['startTime']
+        print('Resuming the run started at', datetime.datetime.fromtimestamp(RUN_STARTED_AT, datetime.timezone.utc).isoformat(), 'after', previousRun.completedChunks, 'completed segments')
+    else:
+        RUN_STARTED_AT = int(time.time())
+        fullSync = args.full or SYNC_STATE.get('watermark') is None
+        if not fullSync and args.full_every is not None and RUN_STARTED_AT - SYNC_STATE.get('lastFullSync', 0) >= args.full_every * 86400:
+            print('Last full sync is older than', args.full_every, 'days')
+            fullSync = True
+        startTime = None if fullSync else SYNC_STATE['watermark']
+    SENDGRID_TIME_WINDOW = '&end_time=' + str(RUN_STARTED_AT)
+    if startTime is not None:
+        SENDGRID_TIME_WINDOW = '&start_time=' + str(startTime) + SENDGRID_TIME_WINDOW
+        print('Processing global unsubscribes created since', datetime.datetime.fromtimestamp(startTime, datetime.timezone.utc).isoformat(), '(incremental sync)')
+    elif fullSync:
+        print('Processing all global unsubscribes (full sync)')
+
+    # Start the journal of this run (or continue the one of the resumed run, or of the run before a replay). Segments an earlier
+    # run left behind are carried over into a new journal, so they are deleted even if this run is interrupted as well.
+    journal = runJournal.RunJournal(args.journal, append=resuming or args.replay)
+    cleanup.callback(journal.close)
+    if args.replay:
+        journal.write('replay', sync=True)
+    else:
+        journal.write('run', sync=True, runStartedAt=RUN_STARTED_AT, fullSync=fullSync, startTime=startTime, resumed=resuming)
+    orphanedSegments = previousRun.orphanedSegments() if previousRun else []
+    if not resuming and not args.replay:
+        for segmentId in orphanedSegments:
+            journal.write('segment-created', segmentId=segmentId)
+
+    # Fetch one page of global unsubscribes, limited to the request budget for Sendgrid
+    sendgridLimiter = rateLimiter.TokenBucket(args.sendgrid_rate)
+    def fetchUnsubscribesPage(offset, limit=SENDGRID_PAGE_SIZE):
+        globalUnsubscribesUrl = SENDGRID_API_BASE_URL + '/suppression/unsubscribes?limit=' + str(limit) + '&offset=' + str(offset) + SENDGRID_TIME_WINDOW
+        globalUnsubscribesResponse = sendgridLimiter.send(lambda: session.get(globalUnsubscribesUrl, headers=SENDGRID_API_HEADERS, timeout=TIMEOUT))
         if globalUnsubscribesResponse.status_code == 200:
-            globalUnsubscribes = json.loads(globalUnsubscribesResponse.text)
-            for globalUnsubscribe in globalUnsubscribes:
-                SENDGRID_UNSUBSCRIBES.append(globalUnsubscribe['email'])
-            print('Retrieved', len(globalUnsubscribes), 'global unsubscribes from Sendgrid')
-            if globalUnsubscribesResponse.links['next'] and globalUnsubscribesResponse.links['next']['url'] and globalUnsubscribesUrl != globalUnsubscribesResponse.links['next']['url']:
-                globalUnsubscribesUrl = globalUnsubscribesResponse.links['next']['url']
-                moreUnsubscribes = True
-            else:
-                moreUnsubscribes = False
-                break
+            return json.loads(globalUnsubscribesResponse.text)
         else:
-            raise ValueError('Unexpected response code ' + str(globalUnsubscribesResponse.status_code) + ' when fetching global unsubscribes')
+            raise ValueError('Unexpected response code ' + str(globalUnsubscribesResponse.status_code) + ' when fetching global unsubscribes at offset ' + str(offset))
+
+    # Sendgrid does not report the total number of global unsubscribes, so find it with an exponential
+    # and then a binary search for the first offset without entries (requesting a single entry each time)
+    def probeUnsubscribesCount():
+        if not fetchUnsubscribesPage(0, 1):
+            return 0
+        lower, upper = 0, SENDGRID_PAGE_SIZE
+        while fetchUnsubscribesPage(upper, 1):
+            lower, upper = upper, upper * 2
+        while upper - lower > 1:
+            middle = (lower + upper) // 2
+            if fetchUnsubscribesPage(middle, 1):
+                lower = middle
+            else:
+                upper = middle
+        return upper
+
+    # Fetch global unsubscribes by requesting the pages concurrently, deduplicating (case-insensitive) emails as pages arrive
+    SENDGRID_UNSUBSCRIBES = emailSet.EmailSet()
+    cleanup.callback(SENDGRID_UNSUBSCRIBES.close)
+    fetchedUnsubscribes = 0
+    watermark = SYNC_STATE.get('watermark')
+    if not args.replay:
+        try:
+            unsubscribesCount = probeUnsubscribesCount()
+            print('Sendgrid reports', unsubscribesCount, 'global unsubscribes, fetching them with', SENDGRID_WORKERS, 'workers')
+            with concurrent.futures.ThreadPoolExecutor(max_workers=SENDGRID_WORKERS) as executor:
+                # Keep at most two pages per worker requested, so pages are dropped once their emails are added to the set
+                offsets = iter(range(0, unsubscribesCount, SENDGRID_PAGE_SIZE))
+                inFlight = {executor.submit(fetchUnsubscribesPage, offset) for offset in itertools.islice(offsets, 2 * SENDGRID_WORKERS)}
+                while inFlight:
+                    done, inFlight = concurrent.futures.wait(inFlight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        globalUnsubscribes = future.result()
+                        fetchedUnsubscribes += len(globalUnsubscribes)
+                        for globalUnsubscribe in globalUnsubscribes:
+                            SENDGRID_UNSUBSCRIBES.add(globalUnsubscribe['email'])
+                            if watermark is None or globalUnsubscribe['created'] > watermark:
+                                watermark = globalUnsubscribe['created']
+                        print('Retrieved', len(globalUnsubscribes), 'global unsubscribes from Sendgrid')
+                        nextOffset = next(offsets, None)
+                        if nextOffset is not None:
+                            inFlight.add(executor.submit(fetchUnsubscribesPage, nextOffset))
+        except Exception:
+            print('Fetching global unsubscribes failed')
+            traceback.print_exc()
+            return 1
+        print('Fetched a total of', fetchedUnsubscribes, 'global unsubscribes from Sendgrid,', len(SENDGRID_UNSUBSCRIBES), 'remaining after deduplication')
+        if metrics:
+            metrics.setValue('sendgrid_unsubscribes', len(SENDGRID_UNSUBSCRIBES))
+
+    # Skip the email addresses of users confirmed as opted out by earlier runs, checked batch by batch while the segments are built
+    store = None
+    if not args.no_store:
+        store = optOutStore.OptOutStore(args.store, ttl=args.revalidate_days * 86400)
+        cleanup.callback(store.close)
+    skippedUnsubscribes = 0
+    resumedUnsubscribes = 0
+    retryingEmails = previousRun.retryingEmails() if resuming else set()
+    def pendingUnsubscribes():
+        nonlocal skippedUnsubscribes, resumedUnsubscribes
+        emails = iter(SENDGRID_UNSUBSCRIBES)
+        while True:
+            batch = list(itertools.islice(emails, optOutStore.QUERY_BATCH_SIZE))
+            if not batch:
+                return
+            if resuming: # Skip the email addresses of chunks the interrupted run completed or queued for a retry
+                pending = [email for email in batch if email not in previousRun.completedEmails and emailSet.normalizeEmail(email) not in retryingEmails]
+                resumedUnsubscribes += len(batch) - len(pending)
+                batch = pending
+            knownOptedOut = store.knownOptedOut(batch) if store else ()
+            skippedUnsubscribes += len(knownOptedOut)
+            yield from (email for email in batch if emailSet.normalizeEmail(email) not in knownOptedOut)
+
+    # Log in to CrossEngage (or re-use the cached login)
+    try:
+        client.login()
     except Exception:
-        print('Fetching global unsubscribes failed')
+        print('Logging in failed')
         traceback.print_exc()
-        sys.exit(1)
-print('Fetched a toal of', len(SENDGRID_UNSUBSCRIBES),'global unsubscribes from Sendgrid')
-SENDGRID_UNSUBSCRIBES = list(set(SENDGRID_UNSUBSCRIBES))
-print(len(SENDGRID_UNSUBSCRIBES),'unsubscribes remaining after deduplication')
-
-# Identify the CrossEngage Company ID
-companyIdurl = UI_BASE_URL + '/managers/companies'
-companyIdPayload = {
-    'email': XNG_USER
-}
-try:
-    companyIdResponse = session.post(companyIdurl, data=json.dumps(companyIdPayload), timeout=TIMEOUT)
-    if companyIdResponse.status_code == 200:
-        companyIds = json.loads(companyIdResponse.text)
-        if len(companyIds) != 1:
-            raise ValueError('Unexpected number of company IDs returned: ' + companyIdResponse.text)
-        else:
-            companyId = companyIds[0]
-            print('Found CrossEngage Company ID', companyId)
-    else:
-        raise ValueError('Unexpected response code ' + str(companyIdResponse.status_code) + ' when fetching company ID')
-except Exception:
-    print('Fetching company ID failed')
-    traceback.print_exc()
-    sys.exit(1)
-
-# Getting UI API token
-uiTokenUrl = UI_BASE_URL + '/managers/login'
-uiTokenPayload = {
-    "email": XNG_USER,
-    "password": XNG_PASS
-}
-uiTokenHeaders = {
-    'content-type': 'application/json',
-    'company-id': str(companyId)
-}
-try:
-    uiTokenResponse = session.post(uiTokenUrl, data=json.dumps(uiTokenPayload), headers=uiTokenHeaders, timeout=TIMEOUT)
-    if uiTokenResponse.status_code == 200:
-        uiToken = json.loads(uiTokenResponse.text)['token']
-        print('Retrieved UI token (last 5 characters):', uiToken[-3:])
-    else:
-        raise ValueError('Unexpected response code ' + str(uiTokenResponse.status_code) + ' when fetching UI token')
-except Exception:
-    print('Fetching UI token failed')
-    traceback.print_exc()
-    sys.exit(1)
-
-# Define CrossEngage Headers
-API_HEADERS = {
-    'Content-Type': 'application/json',
-    'X-XNG-ApiVersion': str(1),
-    'X-XNG-AuthToken': API_KEY
-}
-UI_HEADERS = {
-    'Accept': 'application/json',
-    'Content-Type': 'application/json',
-    'Company-ID': str(companyId),
-    'X-XNG-ApiVersion': str(2),
-    'Authorization': 'Bearer ' + uiToken
-}
-
-### Identify the correct attribute ID for traits.email (this is required for the segment creation)
-print('Searching attribute ID for traits.email')
-getAttributesUrl = UI_BASE_URL + '/campaigns/event-classes'
-getAttributesResponse = session.get(getAttributesUrl, headers=UI_HEADERS, timeout=TIMEOUT)
-try:
-    if getAttributesResponse.status_code == 200:
+        return 1
+
+    ### Identify the correct attribute ID for traits.email (this is required for the segment creation, or taken from the metadata cache)
+    def findEmailAttributeId():
+        print('Searching attribute ID for traits.email')
+        getAttributesResponse = client.ui('GET', '/campaigns/event-classes')
+        if getAttributesResponse.status_code != 200:
+            raise ValueError('Unexpected response code ' + str(getAttributesResponse.status_code) + ' when fetching attribute details')
         attributeDetails = json.loads(getAttributesResponse.text)
         print('Retrieved attribute details')
-    else:
-        raise ValueError('Unexpected response code ' + str(getAttributesResponse.status_code) + ' when fetching attribute details')
-except Exception:
-    print('Fetching attributes failed')
-    traceback.print_exc()
-    sys.exit(1)
-try:
-    properties = attributeDetails['properties']
-except:
-    print('Fetching attribute details failed')
-    traceback.print_exc()
-    sys.exit(1)
-ID_EMAIL_ATTRIBUTE = None
-for propertyDetail in properties:
-	if propertyDetail['label'] == 'traits.email':
-		ID_EMAIL_ATTRIBUTE = propertyDetail['id']
-		print('Identified ID of traits.email: ' + str(propertyDetail['id']))
-if not ID_EMAIL_ATTRIBUTE:
-    print('Could not find ID of traits.email')
-    sys.exit(1)
-
-### Build segments
-SENDGRID_UNSUBSCRIBE_CHUNKS = [SENDGRID_UNSUBSCRIBES[x:x+MAX_USERS_PER_SEGMENT] for x in range(0, len(SENDGRID_UNSUBSCRIBES), MAX_USERS_PER_SEGMENT)]
-for i, UNSUBSCRIBE_CHUNK in enumerate(SENDGRID_UNSUBSCRIBE_CHUNKS):
-    SEGMENT_NAME = '[Sendgrid Opt-Out Sync] ' + str(uuid.uuid4())[:8]
-    print('Creating segment',i+1,'of',len(SENDGRID_UNSUBSCRIBE_CHUNKS),'as',SEGMENT_NAME,'with',len(UNSUBSCRIBE_CHUNK),'emails')
-    SEGMENT_PAYLOAD = {
-        'label': SEGMENT_NAME,
-        'type': 'CONTAINER',
-        'operator': 'OR',
-        'subFilters': [],
-        'justCreated': False,
-        '$$hashKey': 'object:1340'
-    }
-    for EMAIL in UNSUBSCRIBE_CHUNK:
-        SUBFILTER = {
-            'type': 'ATTRIBUTE',
-            'label': '_gen:_' + str(time.time_ns()),
-            'operator': None,
-            'justCreated': False,
-            'subFilters': [],
-            'conditions': [{
-                'values': [EMAIL],
+        for propertyDetail in attributeDetails['properties']:
+            if propertyDetail['label'] == 'traits.email':
+                print('Identified ID of traits.email: ' + str(propertyDetail['id']))
+                return propertyDetail['id']
+        raise ValueError('Could not find ID of traits.email')
+    try:
+        ID_EMAIL_ATTRIBUTE = metadata.get('emailAttributeId', findEmailAttributeId)
+    except Exception:
+        print('Fetching attributes failed')
+        traceback.print_exc()
+        return 1
+
+    ### Build segments
+    # Every chunk of emails goes through the lifecycle create segment -> count -> fetch users -> opt out users -> delete segment.
+    # Up to SEGMENTS_IN_FLIGHT chunks are processed concurrently, so while the backend counts one segment the users of
+    # others are already opted out. Every created segment is tracked until it is deleted, so none is left behind on failure.
+    createdSegments = set()
+    createdSegmentsLock = threading.Lock()
+
+    # One ATTRIBUTE subfilter whose traits.email condition lists all emails of the segment. The condition keeps
+    # the nested conditions the UI sends, one entry per value, just without its $$hashKey fields.
+    def segmentPayload(segmentName, emails):
+        return {
+            'label': segmentName,
+            'type': 'CONTAINER',
+            'operator': 'OR',
+            'subFilters': [{
+                'type': 'ATTRIBUTE',
+                'label': '_gen:_' + str(time.time_ns()),
+                'operator': None,
+                'justCreated': False,
+                'subFilters': [],
                 'conditions': [{
-                    'values': [''],
-                    '$$hashKey': 'object:1874'
+                    'values': emails,
+                    'conditions': [{'values': ['']} for email in emails],
+                    'valueIdList': list(range(len(emails))),
+                    'attributeId': ID_EMAIL_ATTRIBUTE,
+                    'operator': '=='
                 }],
-                'valueIdList': [0],
-                'attributeId': ID_EMAIL_ATTRIBUTE,
-                'operator': '=='
+                'id': None
             }],
-            'id': None
+            'justCreated': False
         }
-        SEGMENT_PAYLOAD['subFilters'].append(SUBFILTER)
-    createSegmentUrl = UI_BASE_URL + '/campaigns/filters'
-    createSegmentResponse = session.post(createSegmentUrl, data=json.dumps(SEGMENT_PAYLOAD), headers=UI_HEADERS, timeout=TIMEOUT)
-    try:
-        if createSegmentResponse.status_code == 200:
-            newSegment = json.loads(createSegmentResponse.text)
-            print('New segment created with ID', newSegment['id'])
-        else:
-            raise ValueError('Unexpected response code ' + str(createSegmentResponse.status_code) + ' creating segment')
-    except Exception:
-        print('Creating segment failed')
-        traceback.print_exc()
-        sys.exit(1)
 
-    #### Trigger user count to populate segment
-    print('Trigger user count for segment with ID ' + str(newSegment['id']))
-    refreshSegmentUrl = UI_BASE_URL + '/filters/' + str(newSegment['id']) + '/count'
-    refreshSegmentResponse = session.get(refreshSegmentUrl, headers=UI_HEADERS, timeout=TIMEOUT)
-    try:
-        if refreshSegmentResponse.status_code == 200:
-            refreshResult = json.loads(refreshSegmentResponse.text)
-            print('User Count:', refreshResult['total'])
-        else:
-            raise ValueError('Unexpected response code ' + str(createSegmentResponse.status_code) + ' for user count')
-    except Exception:
-        print('User count failed')
-        traceback.print_exc()
-        sys.exit(1)
+    def createSegment(segmentName, emails):
+        createSegmentResponse = client.ui('POST', '/campaigns/filters', data=json.dumps(segmentPayload(segmentName, emails), separators=(',', ':')))
+        if createSegmentResponse.status_code != 200:
+            raise ValueError('Unexpected response code ' + str(createSegmentResponse.status_code) + ' creating segment')
+        segmentId = json.loads(createSegmentResponse.text)['id']
+        with createdSegmentsLock:
+            createdSegments.add(segmentId)
+        journal.write('segment-created', sync=True, segmentId=segmentId)
+        if metrics:
+            metrics.addValue('segments')
+        return segmentId
 
-    #### Fetch users in segment
-    print('Retrieving users in segment with ID', str(newSegment['id']))
-    fetchSegmentUrl = UI_BASE_URL + '/userexplorer/' + str(newSegment['id']) + '?offset=0&limit=' + str(MAX_USERS_PER_SEGMENT)
-    fetchNewSegmentResponse = session.get(fetchSegmentUrl, headers=UI_HEADERS, timeout=TIMEOUT)
-    try:
-        if fetchNewSegmentResponse.status_code == 200:
-            fetchNewSegmentResult = json.loads(fetchNewSegmentResponse.text)
-            newSegmentPart = fetchNewSegmentResult['part']
-        else:
-            raise ValueError('Unexpected response code ' + str(fetchNewSegmentResponse.status_code) + ' when fetching segment users')
-    except Exception:
-        print('Fetching segment users failed')
-        traceback.print_exc()
-        sys.exit(1)
+    def deleteSegment(segmentId):
+        deleteSegmentResponse = client.ui('DELETE', '/filters/' + str(segmentId))
+        if deleteSegmentResponse.status_code not in (204, 404): # 404: already gone
+            raise ValueError('Unexpected response code ' + str(deleteSegmentResponse.status_code) + ' for deletion of segment ' + str(segmentId))
+        with createdSegmentsLock:
+            createdSegments.discard(segmentId)
+        journal.write('segment-deleted', segmentId=segmentId)
+        print('Segment with ID', segmentId, 'deleted')
 
-    #### Check opt-out status for each user in segment and opt out if required
-    for xngUser in newSegmentPart:
+    # Users are opted out by a pool of workers shared by all segments, their requests stay within the budget of crossengageLimiter.
+    # optOutUser() returns the user with the method that confirmed the opt-out ('existing', 'api' or 'link').
+    crossengageLimiter = rateLimiter.TokenBucket(args.rate)
+    userExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=USER_WORKERS)
+    cleanup.callback(userExecutor.shutdown)
+    def optOutUser(xngUser):
         if xngUser['externalId']:
             print('Fetching opt out status for user with xngGlobalUserId', xngUser['xngGlobalUserId'], 'and email', xngUser['email'])
-            optOutStatusUrl = API_BASE_URL + '/users/' + xngUser['externalId'] + '/recipient-status'
-            optOutStatusResponse = session.get(optOutStatusUrl, headers=API_HEADERS, timeout=TIMEOUT)
-            try:
-                if optOutStatusResponse.status_code == 200:
-                    optOutStatusResult = json.loads(optOutStatusResponse.text)
-                    optedOut = optOutStatusResult['optOutAll']
-                else:
-                    raise ValueError('Unexpected response code ' + str(optOutStatusResponse.status_code) + ' when fetching opt out status')
-            except Exception:
-                print('Fetching opt out status failed')
-                traceback.print_exc()
-                sys.exit(1)
-            if optedOut == True:
+            optOutStatusResponse = crossengageLimiter.send(lambda: client.api('GET', '/users/' + xngUser['externalId'] + '/recipient-status', apiVersion=1))
+            if optOutStatusResponse.status_code != 200:
+                raise ValueError('Unexpected response code ' + str(optOutStatusResponse.status_code) + ' when fetching opt out status of user ' + xngUser['xngGlobalUserId'])
+            if json.loads(optOutStatusResponse.text)['optOutAll'] == True:
                 print('User with xngGlobalUserId', xngUser['xngGlobalUserId'], 'and email', xngUser['email'], 'is already opted out')
-            else:
-                print('Opting out user with xngGlobalUserId', xngUser['xngGlobalUserId'], 'and email', xngUser['email'])
-                optOutUrl = API_BASE_URL + '/users/' + xngUser['externalId'] + '/optout-status'
-                optOutPayload = {
-                    'optOut': True
-                }
-                optOutResponse = session.put(optOutUrl, data=json.dumps(optOutPayload), headers=API_HEADERS, timeout=TIMEOUT)
-                try:
-                    if optOutResponse.status_code == 200:
-                        optOutResult = json.loads(optOutResponse.text)
-                        newOptOutStatus = optOutResult['optOut']
-                        if newOptOutStatus != True:
-                            raise ValueError('Unexpected opt out status after update: ' + str(newOptOutStatus))
-                    else:
-                        raise ValueError('Unexpected response code ' + str(optOutStatusResponse.status_code) + ' when opting out')
-                except Exception:
-                    print('Opting out failed')
-                    traceback.print_exc()
-                    sys.exit(1)
-                print('User with xngGlobalUserId', xngUser['xngGlobalUserId'], 'and email', xngUser['email'], 'opted out successfully')
+                if metrics:
+                    metrics.addValue('users_already_opted_out')
+                return xngUser, 'existing'
+            print('Opting out user with xngGlobalUserId', xngUser['xngGlobalUserId'], 'and email', xngUser['email'])
+            optOutPayload = {
+                'optOut': True
+            }
+            optOutResponse = crossengageLimiter.send(lambda: client.api('PUT', '/users/' + xngUser['externalId'] + '/optout-status', data=json.dumps(optOutPayload), apiVersion=1))
+            if optOutResponse.status_code != 200:
+                raise ValueError('Unexpected response code ' + str(optOutResponse.status_code) + ' when opting out user ' + xngUser['xngGlobalUserId'])
+            newOptOutStatus = json.loads(optOutResponse.text)['optOut']
+            if newOptOutStatus != True:
+                raise ValueError('Unexpected opt out status after update: ' + str(newOptOutStatus))
+            print('User with xngGlobalUserId', xngUser['xngGlobalUserId'], 'and email', xngUser['email'], 'opted out successfully')
+            if metrics:
+                metrics.addValue('users_opted_out')
+            return xngUser, 'api'
         else:
             print('No external ID found for user with xngGlobalUserId', xngUser['xngGlobalUserId'], 'and email', xngUser['email'])
             print('Attempting to opt out user through opt out link workaround')
-            optOutLinkUrl = 'https://trk-api.crossengage.io/optout/inbound/webhook/' + WEB_TRACKING_KEY + '/' + xngUser['xngGlobalUserId'] + '?channelType=all'
-            optOutLinkResponse = session.get(optOutLinkUrl, timeout=TIMEOUT)
+            optOutLinkUrl = TRACKING_BASE_URL + '/optout/inbound/webhook/' + WEB_TRACKING_KEY + '/' + xngUser['xngGlobalUserId'] + '?channelType=all'
+            optOutLinkResponse = crossengageLimiter.send(lambda: session.get(optOutLinkUrl, timeout=TIMEOUT))
+            if optOutLinkResponse.status_code != 200:
+                raise ValueError('Unexpected response code ' + str(optOutLinkResponse.status_code) + ' when using opt out link workaround for user ' + xngUser['xngGlobalUserId'])
+            print('User with xngGlobalUserId', xngUser['xngGlobalUserId'], 'and email', xngUser['email'], 'was opted out successfully through opt out link method (Response:', optOutLinkResponse.text.replace('\n', ' ').replace('\r', ''), ')')
+            if metrics:
+                metrics.addValue('users_opted_out_via_link')
+            return xngUser, 'link'
+
+    # Record a confirmed opt-out in the journal
+    def journalConfirmation(xngUser, method):
+        journal.write('user', email=xngUser['email'], xngGlobalUserId=xngUser['xngGlobalUserId'], externalId=xngUser['externalId'], method=method)
+
+    # A user whose opt-out failed is handed to the retry queue, so the segment continues with the other users
+    def optOutUserOrRetry(xngUser):
+        try:
+            return optOutUser(xngUser)
+        except Exception:
+            print('Opting out user with xngGlobalUserId', xngUser['xngGlobalUserId'], 'and email', xngUser['email'], 'failed, it will be retried')
+            traceback.print_exc()
+            queueRetry('user', xngUser)
+            return None
+
+    # Read the users of a segment page by page until a page is not full
+    def iterSegmentUsers(segmentId):
+        offset = 0
+        while True:
+            fetchSegmentUsersResponse = client.ui('GET', '/userexplorer/' + str(segmentId) + '?offset=' + str(offset) + '&limit=' + str(USER_EXPLORER_PAGE_SIZE))
+            if fetchSegmentUsersResponse.status_code != 200:
+                raise ValueError('Unexpected response code ' + str(fetchSegmentUsersResponse.status_code) + ' when fetching users of segment ' + str(segmentId))
+            segmentUsers = json.loads(fetchSegmentUsersResponse.text)['part']
+            yield from segmentUsers
+            if len(segmentUsers) < USER_EXPLORER_PAGE_SIZE:
+                return
+            offset += USER_EXPLORER_PAGE_SIZE
+
+    def processChunk(chunkNumber, emails):
+        segmentName = '[Sendgrid Opt-Out Sync] ' + str(uuid.uuid4())[:8]
+        print('Creating segment', chunkNumber, 'as', segmentName, 'with', len(emails), 'emails')
+        segmentId = createSegment(segmentName, emails)
+        print('New segment created with ID', segmentId)
+        try:
+            #### Trigger user count to populate segment
+            print('Trigger user count for segment with ID', segmentId)
+            refreshSegmentResponse = client.ui('GET', '/filters/' + str(segmentId) + '/count')
+            if refreshSegmentResponse.status_code != 200:
+                raise ValueError('Unexpected response code ' + str(refreshSegmentResponse.status_code) + ' for user count of segment ' + str(segmentId))
+            print('User Count of segment with ID', segmentId, ':', json.loads(refreshSegmentResponse.text)['total'])
+
+            #### Check opt-out status for each user in segment and opt out if required
+            print('Retrieving users in segment with ID', segmentId)
+            confirmations = []
+            for confirmation in userExecutor.map(optOutUserOrRetry, iterSegmentUsers(segmentId)):
+                if confirmation:
+                    journalConfirmation(*confirmation)
+                    confirmations.append(confirmation)
+            if store:
+                store.record(confirmations)
+        finally:
+            #### Our work is done (or failed), now deleting segment (the final sweep tries again if this fails)
+            print('Deleting segment with ID', segmentId)
             try:
-                if optOutLinkResponse.status_code == 200:
-                    print('User with xngGlobalUserId', xngUser['xngGlobalUserId'], 'and email', xngUser['email'], 'was opted out successfully through opt out link method (Response:', optOutLinkResponse.text.replace('\n', ' ').replace('\r', ''), ')')
-                else:
-                    raise ValueError('Unexpected response code ' + str(fetchNewSegmentResponse.status_code) + ' when using opt out link workaround')
+                deleteSegment(segmentId)
             except Exception:
-                print('Opt out link workaround failed')
+                print('Deleting segment with ID', segmentId, 'failed, trying again at the end of the run')
                 traceback.print_exc()
-                sys.exit(1)
+        journal.write('chunk-done', sync=True, chunk=chunkNumber, segmentId=segmentId, emails=emails)
 
-    #### Our work is done, now deleting segment
-    print('Deleting segment with ID ' + str(newSegment['id']))
-    deleteSegmentUrl = UI_BASE_URL + '/filters/' + str(newSegment['id'])
-    deleteSegmentResponse = session.delete(deleteSegmentUrl, headers=UI_HEADERS, timeout=TIMEOUT)
-    try:
-        if deleteSegmentResponse.status_code == 204:
-            print('Segment with ID', newSegment['id'], 'deleted')
+    # Split the emails into chunks of up to MAX_USERS_PER_SEGMENT emails whose segment payload stays within MAX_SEGMENT_BYTES
+    def chunkUnsubscribes(emails):
+        emptyPayloadBytes = len(json.dumps(segmentPayload('[Sendgrid Opt-Out Sync] 00000000', []), separators=(',', ':')))
+        nestedConditionBytes = len(json.dumps({'values': ['']}, separators=(',', ':')))
+        chunk = []
+        chunkBytes = emptyPayloadBytes
+        for email in emails:
+            emailBytes = len(json.dumps(email)) + nestedConditionBytes + len(str(len(chunk))) + 3 # Value, its nested condition, its index in valueIdList and three commas
+            if chunk and (len(chunk) >= MAX_USERS_PER_SEGMENT or chunkBytes + emailBytes > MAX_SEGMENT_BYTES):
+                yield chunk
+                chunk = []
+                chunkBytes = emptyPayloadBytes
+                emailBytes = len(json.dumps(email)) + nestedConditionBytes + 4
+            chunk.append(email)
+            chunkBytes += emailBytes
+        if chunk:
+            yield chunk
+
+    # Delete the segments an interrupted run created but did not delete, the final sweep retries any failures
+    for segmentId in orphanedSegments:
+        print('Deleting segment with ID', segmentId, 'left behind by an interrupted run')
+        with createdSegmentsLock:
+            createdSegments.add(segmentId)
+        try:
+            deleteSegment(segmentId)
+        except Exception:
+            print('Deleting segment with ID', segmentId, 'failed')
+            traceback.print_exc()
+
+    # Users and chunks that failed are retried from a queue while the run continues. Those failing every retry are written to
+    # the dead-letter file for a later --replay. The journal records the queued retries, so a resumed run schedules them again.
+    def retryKey(kind, item):
+        return kind + ':' + str(item['xngGlobalUserId'] if kind == 'user' else item['chunk'])
+
+    def processRetry(kind, item):
+        if kind == 'user':
+            xngUser, method = optOutUser(item)
+            journalConfirmation(xngUser, method)
+            if store:
+                store.record([(xngUser, method)])
         else:
-            raise ValueError('Unexpected response code ' + str(createSegmentResponse.status_code) + ' for segment deletion')
-    except Exception:
-        print('Segment deletion')
-        traceback.print_exc()
-        sys.exit(1)
+            processChunk(item['chunk'], item['emails'])
+
+    def retryFinished(kind, item, succeeded):
+        journal.write('retry-finished', key=retryKey(kind, item), succeeded=succeeded)
+
+    def queueRetry(kind, item, delay=None):
+        journal.write('retry-queued', sync=True, key=retryKey(kind, item), kind=kind, item=item)
+        retries.submit(kind, item, delay=delay)
+
+    deadLetters = retryQueue.DeadLetterFile(args.dead_letters)
+    cleanup.callback(deadLetters.close)
+    retries = retryQueue.RetryQueue(processRetry, deadLetters, attempts=max(1, args.retries), workers=RETRY_WORKERS, onFinished=retryFinished)
+    cleanup.callback(retries.close) # Closed before the files the retries write to
+    if resuming:
+        for kind, item in previousRun.pendingRetries.values():
+            queueRetry(kind, item, delay=0)
+
+    if args.replay:
+        # Move the dead letters aside (together with those of an interrupted replay), so the ones failing again are collected anew
+        replayFile = args.dead_letters + '.replay'
+        deadLetterEntries = retryQueue.readDeadLetters(replayFile) + retryQueue.readDeadLetters(args.dead_letters)
+        with open(replayFile + '.tmp', 'w', encoding='utf-8') as temporaryFile:
+            for entry in deadLetterEntries:
+                temporaryFile.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        os.replace(replayFile + '.tmp', replayFile)
+        if os.path.exists(args.dead_letters):
+            os.remove(args.dead_letters)
+        print('Replaying', len(deadLetterEntries), 'users and segments')
+        for entry in deadLetterEntries:
+            if entry['kind'] == 'user':
+                queueRetry('user', entry['item'], delay=0)
+        SENDGRID_UNSUBSCRIBE_CHUNKS = (entry['item']['emails'] for entry in deadLetterEntries if entry['kind'] == 'chunk')
+    else:
+        # The chunks are built lazily, only as many as there are segments in flight exist at a time
+        SENDGRID_UNSUBSCRIBE_CHUNKS = chunkUnsubscribes(pendingUnsubscribes())
+
+    # A chunk that failed as a whole (e.g. creating its segment) goes to the retry queue as well
+    def chunkFinished(future, chunkNumber, emails):
+        if future.exception():
+            print('Processing segment', chunkNumber, 'failed, it will be retried')
+            traceback.print_exception(type(future.exception()), future.exception(), future.exception().__traceback__)
+            queueRetry('chunk', {'chunk': chunkNumber, 'emails': emails})
+
+    print('Processing segments with up to', SEGMENTS_IN_FLIGHT, 'in flight')
+    firstChunkNumber = previousRun.lastChunk + 1 if resuming else 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SEGMENTS_IN_FLIGHT) as executor:
+        inFlight = {}
+        for i, unsubscribeChunk in enumerate(SENDGRID_UNSUBSCRIBE_CHUNKS):
+            # Only submit the next chunk when a slot is free
+            if len(inFlight) >= SEGMENTS_IN_FLIGHT:
+                done, _ = concurrent.futures.wait(inFlight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    chunkFinished(future, *inFlight.pop(future))
+            inFlight[executor.submit(processChunk, firstChunkNumber + i, unsubscribeChunk)] = (firstChunkNumber + i, unsubscribeChunk)
+        for future in concurrent.futures.as_completed(list(inFlight)):
+            chunkFinished(future, *inFlight.pop(future))
+    retries.join()
+    print(retries.succeeded, 'retries succeeded,', deadLetters.count, 'users and segments written to', args.dead_letters)
+    if metrics:
+        metrics.setValue('retries_succeeded', retries.succeeded)
+        metrics.setValue('dead_letters', deadLetters.count)
+    if deadLetters.count:
+        print('Process them again with --replay')
+    if args.replay:
+        os.remove(replayFile)
+
+    # Final sweep: delete the segments whose deletion failed before
+    failed = False
+    for segmentId in sorted(createdSegments):
+        print('Deleting remaining segment with ID', segmentId)
+        try:
+            deleteSegment(segmentId)
+        except Exception:
+            print('Segment deletion failed, please delete segment with ID', segmentId, 'manually')
+            traceback.print_exc()
+            failed = True
+    if resuming:
+        print('Skipped', resumedUnsubscribes, 'email addresses processed or queued for a retry before the interruption')
+    if store and not args.replay:
+        print('Skipped', skippedUnsubscribes, 'email addresses of users confirmed as opted out in the last', args.revalidate_days, 'days')
+        if metrics:
+            metrics.setValue('users_known_opted_out', skippedUnsubscribes)
+    if failed:
+        return 1
+    if args.replay:
+        journal.write('replay-done', sync=True)
+        if metrics:
+            metrics.setValue('success', 1)
+        return 0
+
+    # Everything up to the watermark has been processed, the next run can start from there
+    SYNC_STATE['watermark'] = watermark if watermark is not None else SYNC_STATE.get('watermark')
+    if fullSync:
+        SYNC_STATE['lastFullSync'] = RUN_STARTED_AT
+    SYNC_STATE['lastSync'] = RUN_STARTED_AT
+    writeSyncState(SYNC_STATE)
+    print('Saved watermark', SYNC_STATE['watermark'], 'to', args.state_file)
+    journal.write('run-done', sync=True)
+
+    if metrics:
+        metrics.setValue('full_sync', 1 if fullSync else 0)
+        metrics.setValue('success', 1)
+    return 0
+
+# Run the sync. client, metadata (a metadataCache.MetadataCache) and metrics can be shared with other jobs,
+# e.g. by daemon.py, otherwise they are created for this run. Returns the exit code.
+def run(args, client=None, metadata=None, metrics=None):
+    with contextlib.ExitStack() as cleanup:
+        return syncOptOuts(args, client, metadata or metadataCache.MetadataCache(), metrics, cleanup)
+
+if __name__ == '__main__':
+    lineOutput.install()
+    sys.exit(run(parseArguments()))
@@ -0,0 +1,62 @@
+# Local SQLite store of CrossEngage users known to be opted out, so they are not checked again on every run.
+# Every user is stored with its email address (in lower case), xngGlobalUserId and externalId, the method
+# that confirmed the opt-out ('api' when opted out through the API, 'link' when opted out through the opt-out
+# link workaround, 'existing' when the user already was opted out) and the time of the confirmation.
+# Confirmations older than the TTL are not trusted anymore, so these users are checked again.
+
+import sqlite3, threading, time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS opted_out_users (
+    email TEXT NOT NULL,
+    xng_global_user_id TEXT NOT NULL,
+    external_id TEXT,
+    method TEXT NOT NULL,
+    confirmed_at INTEGER NOT NULL,
+    PRIMARY KEY (email, xng_global_user_id)
+);
+CREATE INDEX IF NOT EXISTS opted_out_users_xng_global_user_id ON opted_out_users (xng_global_user_id);
+CREATE INDEX IF NOT EXISTS opted_out_users_external_id ON opted_out_users (external_id);
+'''
+QUERY_BATCH_SIZE = 500 # Stays below the limit of SQLite for the number of parameters of a statement
+
+class OptOutStore:
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl # Seconds after which a confirmation has to be revalidated, None to trust it forever
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+
+    def oldestValidConfirmation(self):
+        return 0 if self.ttl is None else int(time.time() - self.ttl)
+
+    # Return those of the given email addresses that are confirmed as opted out within the TTL (in lower case)
+    def knownOptedOut(self, emails):
+        known = set()
+        emails = list(emails)
+        oldestValidConfirmation = self.oldestValidConfirmation()
+        with self.lock:
+            for x in range(0, len(emails), QUERY_BATCH_SIZE):
+                batch = [email.lower() for email in emails[x:x+QUERY_BATCH_SIZE]]
+                rows = self.connection.execute('SELECT DISTINCT email FROM opted_out_users WHERE confirmed_at >= ? AND email IN (' + ','.join('?' * len(batch)) + ')', [oldestValidConfirmation] + batch)
+                known.update(email for (email,) in rows)
+        return known
+
+    # Record confirmed opt-outs given as (xngUser, method) pairs in one transaction
+    def record(self, confirmations):
+        confirmedAt = int(time.time())
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO opted_out_users (email, xng_global_user_id, external_id, method, confirmed_at) VALUES (?, ?, ?, ?, ?)', [
+                ((xngUser['email'] or '').lower(), xngUser['xngGlobalUserId'], xngUser['externalId'], method, confirmedAt) for xngUser, method in confirmations
+            ])
+
+    # Number of stored users per method
+    def counts(self):
+        with self.lock:
+            return dict(self.connection.execute('SELECT method, COUNT(*) FROM opted_out_users GROUP BY method'))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
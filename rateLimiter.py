@@ -0,0 +1,69 @@
+# Thread-safe token bucket to keep concurrent workers within a request budget.
+# acquire() blocks until a token is available. Tokens refill continuously at `rate` per second
+# up to `burst` tokens, so short bursts are allowed while the average rate stays within budget.
+# send() also backs off when the server answers 429 Too Many Requests: it pauses the bucket for all
+# workers, for as long as the Retry-After header asks or with exponential backoff if there is none.
+# Connection errors and 5xx responses retried by the session (see crossengageClient.createSession) are not
+# counted against the budget, only the request handed to send() is.
+
+import email.utils, random, threading, time
+
+class TokenBucket:
+    def __init__(self, rate, burst=None, maxAttempts=6, backoffBase=1.0, backoffCap=60.0):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.maxAttempts = maxAttempts
+        self.backoffBase = backoffBase
+        self.backoffCap = backoffCap
+        self.tokens = self.burst
+        self.updatedAt = time.monotonic()
+        self.pausedUntil = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.pausedUntil:
+                    wait = self.pausedUntil - now
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - max(self.updatedAt, self.pausedUntil)) * self.rate)
+                    self.updatedAt = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    # Stop handing out tokens for the given number of seconds and start again with an empty bucket
+    def pause(self, seconds):
+        with self.lock:
+            self.pausedUntil = max(self.pausedUntil, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+    # Call send() (which performs one request and returns its response) within the budget, repeating it after a pause while it is rate limited
+    def send(self, send):
+        for attempt in range(self.maxAttempts):
+            self.acquire()
+            response = send()
+            if response.status_code != 429 or attempt == self.maxAttempts - 1:
+                return response
+            delay = retryAfterSeconds(response.headers.get('Retry-After'))
+            if delay is None:
+                delay = min(self.backoffCap, self.backoffBase * 2 ** attempt) * random.uniform(0.5, 1.0)
+            response.close()
+            print('Rate limited, pausing requests for', round(delay, 2), 'seconds')
+            self.pause(delay)
+
+# Seconds to wait according to a Retry-After header (delay in seconds or HTTP date), None if missing or unreadable
+def retryAfterSeconds(retryAfter):
+    if not retryAfter:
+        return None
+    try:
+        return max(0.0, float(retryAfter))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(retryAfter).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,204 @@
+# Per-endpoint request metrics for the scripts in this repository.
+# instrument() hooks into the transport adapters of a requests session and records count,
+# status codes, response bytes, retries and a latency histogram for each endpoint template
+# (e.g. GET /campaign/{id}/stats). writeReport() writes them together with run level values
+# as JSON or, for file names ending with .prom, in the Prometheus textfile format.
+
+import json, os, re, threading, time
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+ENDPOINT_TEMPLATES = [
+    (re.compile(r'/campaign/[^/]+/stats$'), '/campaign/{id}/stats'),
+    (re.compile(r'/filters/[^/]+/count$'), '/filters/{id}/count'),
+    (re.compile(r'/campaigns/filters$'), '/campaigns/filters'),
+    (re.compile(r'/campaigns/event-classes$'), '/campaigns/event-classes'),
+    (re.compile(r'/campaigns$'), '/campaigns'),
+    (re.compile(r'/filters/[^/]+$'), '/filters/{id}'),
+    (re.compile(r'/userexplorer/[^/]+$'), '/userexplorer/{id}'),
+    (re.compile(r'/users/[^/]+/recipient-status$'), '/users/{id}/recipient-status'),
+    (re.compile(r'/users/[^/]+/optout-status$'), '/users/{id}/optout-status'),
+    (re.compile(r'/optout/inbound/webhook/[^/]+/[^/]+$'), '/optout/inbound/webhook/{key}/{id}'),
+    (re.compile(r'/statistics/kpi$'), '/statistics/kpi'),
+    (re.compile(r'/managers/companies$'), '/managers/companies'),
+    (re.compile(r'/managers/login$'), '/managers/login'),
+    (re.compile(r'/suppression/unsubscribes$'), '/suppression/unsubscribes')
+]
+
+# Reduce a URL to its endpoint template, unknown paths get every segment containing a digit replaced
+def endpointTemplate(url):
+    path = url.split('://', 1)[-1]
+    path = '/' + path.split('/', 1)[1] if '/' in path else '/'
+    path = path.split('?', 1)[0]
+    for pattern, template in ENDPOINT_TEMPLATES:
+        if pattern.search(path):
+            return template
+    return '/'.join('{id}' if re.search(r'\d', segment) else segment for segment in path.split('/'))
+
+class EndpointMetrics:
+    def __init__(self):
+        self.count = 0
+        self.statusCodes = {}
+        self.bytes = 0
+        self.retries = 0
+        self.latencySum = 0.0
+        self.latencyBuckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    # Estimate a latency quantile from the histogram (upper bound of the bucket it falls into, None above the last bucket)
+    def quantile(self, q):
+        rank = q * self.count
+        seen = 0
+        for i, bucketCount in enumerate(self.latencyBuckets):
+            seen += bucketCount
+            if seen >= rank and bucketCount:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else None
+        return 0.0
+
+class RequestMetrics:
+    def __init__(self, job):
+        self.job = job
+        self.startedAt = time.time()
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.values = {}
+
+    # Wrap the send() method of every adapter mounted on the session
+    def instrument(self, session):
+        for adapter in set(session.adapters.values()):
+            adapter.send = self.wrapSend(adapter.send)
+        return session
+
+    def wrapSend(self, send):
+        def instrumentedSend(request, stream=False, **kwargs):
+            start = time.perf_counter()
+            try:
+                response = send(request, stream=stream, **kwargs)
+                if stream:
+                    responseBytes = 0 # Counted while the body is read, see countStreamedBytes()
+                else:
+                    responseBytes = len(response.content) # Read here (instead of in the session) to time the whole download
+            except Exception:
+                self.record(request.method, request.url, 'error', time.perf_counter() - start, 0, 0)
+                raise
+            retries = getattr(getattr(response.raw, 'retries', None), 'history', None) or ()
+            self.record(request.method, request.url, response.status_code, time.perf_counter() - start, responseBytes, len(retries))
+            if stream:
+                self.countStreamedBytes(request, response)
+            return response
+        return instrumentedSend
+
+    # Count the (decoded) bytes of a streamed response as they are read, as for non-streamed responses. Content-Length
+    # would be missing for chunked responses and only give the compressed size for gzip encoded ones.
+    def countStreamedBytes(self, request, response):
+        endpoint = self.endpoints[(request.method, endpointTemplate(request.url))]
+        raw = response.raw
+        read, readChunked = raw.read, raw.read_chunked
+        def countingRead(*args, **kwargs):
+            data = read(*args, **kwargs)
+            with self.lock:
+                endpoint.bytes += len(data)
+            return data
+        def countingReadChunked(*args, **kwargs):
+            for data in readChunked(*args, **kwargs):
+                with self.lock:
+                    endpoint.bytes += len(data)
+                yield data
+        raw.read, raw.read_chunked = countingRead, countingReadChunked
+
+    def record(self, method, url, status, seconds, responseBytes, retries):
+        key = (method, endpointTemplate(url))
+        with self.lock:
+            endpoint = self.endpoints.get(key)
+            if endpoint is None:
+                endpoint = self.endpoints[key] = EndpointMetrics()
+            endpoint.count += 1
+            endpoint.statusCodes[str(status)] = endpoint.statusCodes.get(str(status), 0) + 1
+            endpoint.bytes += responseBytes
+            endpoint.retries += retries
+            endpoint.latencySum += seconds
+            bucket = 0
+            while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+                bucket += 1
+            endpoint.latencyBuckets[bucket] += 1
+
+    # Run level values such as the number of rows written or users opted out
+    def setValue(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def addValue(self, name, value=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def report(self):
+        with self.lock:
+            duration = time.time() - self.startedAt
+            totalRequests = sum(endpoint.count for endpoint in self.endpoints.values())
+            return {
+                'job': self.job,
+                'startedAt': self.startedAt,
+                'durationSeconds': round(duration, 3),
+                'requests': totalRequests,
+                'requestsPerSecond': round(totalRequests / duration, 3) if duration else 0,
+                'values': dict(self.values),
+                'endpoints': [{
+                    'method': method,
+                    'endpoint': template,
+                    'count': endpoint.count,
+                    'statusCodes': dict(endpoint.statusCodes),
+                    'bytes': endpoint.bytes,
+                    'retries': endpoint.retries,
+                    'latencySeconds': {
+                        'sum': round(endpoint.latencySum, 6),
+                        'mean': round(endpoint.latencySum / endpoint.count, 6),
+                        'p50': endpoint.quantile(0.5),
+                        'p90': endpoint.quantile(0.9),
+                        'p99': endpoint.quantile(0.99),
+                        'buckets': dict(zip([str(bucket) for bucket in LATENCY_BUCKETS] + ['+Inf'], endpoint.latencyBuckets))
+                    }
+                } for (method, template), endpoint in sorted(self.endpoints.items(), key=lambda item: (item[0][1], item[0][0]))]
+            }
+
+    def prometheusText(self):
+        return prometheusText([self.report()])
+
+    # Write the report atomically, so a textfile collector never reads a half written file
+    def writeReport(self, path):
+        if path.endswith('.prom'):
+            text = self.prometheusText()
+        else:
+            text = json.dumps(self.report(), indent=2)
+        temporaryPath = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temporaryPath, 'w', encoding='utf-8') as reportFile:
+            reportFile.write(text)
+        os.replace(temporaryPath, path)
+        print('Wrote request metrics to', path)
+
+# Prometheus text of one or more reports (e.g. of the jobs of daemon.py), each metric is declared once with a sample per job
+def prometheusText(reports):
+    lines = []
+    def add(name, kind, helpText, samples):
+        lines.append('# HELP xng_' + name + ' ' + helpText)
+        lines.append('# TYPE xng_' + name + ' ' + kind)
+        for labels, value in samples:
+            labelText = ','.join(key + '="' + str(labelValue).replace('\\', '\\\\').replace('"', '\\"') + '"' for key, labelValue in labels)
+            lines.append('xng_' + name + '{' + labelText + '} ' + str(value))
+    endpoints = [(report['job'], e) for report in reports for e in report['endpoints']]
+    add('requests_total', 'counter', 'Requests by endpoint and status code', [([('job', job), ('method', e['method']), ('endpoint', e['endpoint']), ('status', status)], count) for job, e in endpoints for status, count in sorted(e['statusCodes'].items())])
+    add('response_bytes_total', 'counter', 'Response body bytes by endpoint', [([('job', job), ('method', e['method']), ('endpoint', e['endpoint'])], e['bytes']) for job, e in endpoints])
+    add('request_retries_total', 'counter', 'Transport level retries by endpoint', [([('job', job), ('method', e['method']), ('endpoint', e['endpoint'])], e['retries']) for job, e in endpoints])
+    lines.append('# HELP xng_request_duration_seconds Request latency by endpoint')
+    lines.append('# TYPE xng_request_duration_seconds histogram')
+    for job, e in endpoints:
+        labels = 'job="' + job + '",method="' + e['method'] + '",endpoint="' + e['endpoint'] + '"'
+        cumulative = 0
+        for bucket, bucketCount in e['latencySeconds']['buckets'].items():
+            cumulative += bucketCount
+            lines.append('xng_request_duration_seconds_bucket{' + labels + ',le="' + bucket + '"} ' + str(cumulative))
+        lines.append('xng_request_duration_seconds_sum{' + labels + '} ' + str(e['latencySeconds']['sum']))
+        lines.append('xng_request_duration_seconds_count{' + labels + '} ' + str(e['count']))
+    add('run_duration_seconds', 'gauge', 'Duration of the run', [([('job', report['job'])], report['durationSeconds']) for report in reports])
+    add('run_requests_per_second', 'gauge', 'Average request throughput of the run', [([('job', report['job'])], report['requestsPerSecond']) for report in reports])
+    add('run_last_timestamp_seconds', 'gauge', 'Start of the run as unix timestamp', [([('job', report['job'])], int(report['startedAt'])) for report in reports])
+    for name in sorted(set(name for report in reports for name in report['values'])):
+        add('run_' + re.sub(r'[^a-zA-Z0-9_]', '_', name), 'gauge', 'Run level value ' + name, [([('job', report['job'])], report['values'][name]) for report in reports if name in report['values']])
+    return '\n'.join(lines) + '\n'
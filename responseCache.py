@@ -0,0 +1,46 @@
+# Content-addressed on-disk cache for API responses.
+# Entries are addressed by the SHA-256 hash of the parts identifying a request (e.g. company,
+# campaign and day) and stored as files in a two-level directory tree below the cache directory.
+
+import contextlib, hashlib, os, tempfile
+
+class ResponseCache:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, *keyParts):
+        digest = hashlib.sha256('\x1f'.join(str(part) for part in keyParts).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + '.json')
+
+    # Open the cached response for reading as binary file or return None if there is no entry for the key
+    def openEntry(self, *keyParts):
+        try:
+            return open(self.path(*keyParts), 'rb')
+        except FileNotFoundError:
+            return None
+
+    # Write a new entry through the yielded binary file, it only becomes visible if the block succeeds
+    @contextlib.contextmanager
+    def newEntry(self, *keyParts):
+        path = self.path(*keyParts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fileDescriptor, temporaryPath = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fileDescriptor, 'wb') as cacheFile:
+                yield cacheFile
+            os.replace(temporaryPath, path)
+        except BaseException:
+            os.unlink(temporaryPath)
+            raise
+
+# Binary file object that copies everything read from source into sink, used to fill the
+# cache while a response is decoded from the network stream
+class TeeReader:
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.sink.write(data)
+        return data
@@ -0,0 +1,116 @@
+# Retry queue for items (e.g. single users or whole chunks) whose processing failed, so one failure does not stop a run.
+# Failed items are retried by the worker threads of the queue after an exponential backoff (5, 10, 20, ... seconds
+# by default) while the caller continues with the next items. Items still failing after the last attempt are appended
+# to a dead-letter file (one JSON object per line), from which a later run can replay them.
+
+import heapq, itertools, json, os, random, threading, time, traceback
+
+class DeadLetterFile:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.count = 0
+        self.deadLetterFile = None # Only created once there is a dead letter
+
+    def write(self, kind, item, error, attempts):
+        line = json.dumps({'kind': kind, 'item': item, 'error': error, 'attempts': attempts, 'at': int(time.time())}, separators=(',', ':')) + '\n'
+        with self.lock:
+            if self.deadLetterFile is None:
+                self.deadLetterFile = open(self.path, 'a', encoding='utf-8')
+            self.deadLetterFile.write(line)
+            self.deadLetterFile.flush()
+            os.fsync(self.deadLetterFile.fileno())
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            if self.deadLetterFile is not None:
+                self.deadLetterFile.close()
+
+# Read the entries of a dead-letter file, a line cut off by a crash is ignored
+def readDeadLetters(path):
+    entries = []
+    try:
+        with open(path, 'r', encoding='utf-8') as deadLetterFile:
+            for line in deadLetterFile:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return entries
+
+class RetryQueue:
+    # process(kind, item) raises if the item failed again, onFinished(kind, item, succeeded) is called once an item leaves the queue
+    def __init__(self, process, deadLetters, attempts=3, workers=4, backoffBase=5.0, backoffCap=300.0, onFinished=None):
+        self.process = process
+        self.deadLetters = deadLetters
+        self.attempts = attempts
+        self.backoffBase = backoffBase
+        self.backoffCap = backoffCap
+        self.onFinished = onFinished
+        self.condition = threading.Condition()
+        self.scheduled = [] # Heap of (due, sequence number, kind, item, attempt)
+        self.sequence = itertools.count()
+        self.pending = 0 # Items scheduled or being processed
+        self.closed = False
+        self.succeeded = 0
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def backoff(self, attempt):
+        return min(self.backoffCap, self.backoffBase * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+    # Schedule an item for its next attempt, after the backoff for this attempt unless a delay is given
+    def submit(self, kind, item, attempt=1, delay=None):
+        with self.condition:
+            due = time.monotonic() + (self.backoff(attempt) if delay is None else delay)
+            heapq.heappush(self.scheduled, (due, next(self.sequence), kind, item, attempt))
+            self.pending += 1
+            self.condition.notify_all()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.closed and (not self.scheduled or self.scheduled[0][0] > time.monotonic()):
+                    self.condition.wait(self.scheduled[0][0] - time.monotonic() if self.scheduled else None)
+                if self.closed:
+                    return
+                _, _, kind, item, attempt = heapq.heappop(self.scheduled)
+            try:
+                print('Retrying', kind, '(attempt', str(attempt) + ' of ' + str(self.attempts) + ')')
+                self.process(kind, item)
+                with self.condition:
+                    self.succeeded += 1
+                if self.onFinished:
+                    self.onFinished(kind, item, True)
+            except Exception as error:
+                traceback.print_exc()
+                if attempt < self.attempts:
+                    self.submit(kind, item, attempt + 1)
+                else:
+                    print('Giving up on', kind, 'after', attempt, 'retries, writing it to', self.deadLetters.path)
+                    self.deadLetters.write(kind, item, repr(error), attempt)
+                    if self.onFinished:
+                        self.onFinished(kind, item, False)
+            finally:
+                with self.condition:
+                    self.pending -= 1
+                    self.condition.notify_all()
+
+    # Wait until every item succeeded or was written to the dead-letter file, then stop the workers
+    def join(self):
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+        self.close()
+
+    # Stop the workers without waiting for the scheduled items (e.g. when the run fails), an item being processed is finished first
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
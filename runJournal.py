@@ -0,0 +1,87 @@
+# Append-only journal of a run of optOutSendgridGlobalSuppressions.py, one JSON object per line.
+# It records the start of the run (with the Sendgrid time window), every segment created and deleted,
+# the outcome for every user, every completed chunk with its email addresses and the items waiting for a retry,
+# so an interrupted run can be resumed: completed chunks are skipped, segments that were never deleted are
+# cleaned up and the retries that were still pending are scheduled again.
+# Checkpoints (segments created, chunks completed) are written through to disk before the run continues.
+
+import json, os, threading, time
+
+import emailSet
+
+class RunJournal:
+    def __init__(self, path, append=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.journalFile = open(path, 'a' if append else 'w', encoding='utf-8')
+
+    # The event is always the first key, readJournal() relies on it to skip the lines it does not need
+    def write(self, event, sync=False, **values):
+        line = json.dumps(dict(event=event, at=int(time.time()), **values), separators=(',', ':')) + '\n'
+        with self.lock:
+            self.journalFile.write(line)
+            self.journalFile.flush()
+            if sync:
+                os.fsync(self.journalFile.fileno())
+
+    def close(self):
+        with self.lock:
+            self.journalFile.close()
+
+# State of the run recorded in a journal, as needed to resume it
+class JournalState:
+    def __init__(self, resume):
+        self.run = None # The first run entry, holding the Sendgrid time window
+        self.finished = False
+        self.completedEmails = emailSet.EmailSet() if resume else None
+        self.completedChunks = 0
+        self.lastChunk = 0 # Highest chunk number completed or queued for a retry, a resumed run numbers its chunks after it
+        self.createdSegments = set()
+        self.deletedSegments = set()
+        self.pendingRetries = {} # Key -> (kind, item) of the items queued for a retry and not finished yet
+
+    def orphanedSegments(self):
+        return sorted(self.createdSegments - self.deletedSegments)
+
+    # Normalized email addresses of the chunks still waiting for a retry, which must not be put into new segments as well
+    def retryingEmails(self):
+        return set(emailSet.normalizeEmail(email) for kind, item in self.pendingRetries.values() if kind == 'chunk' for email in item['emails'])
+
+# Read a journal, returns None if there is none. A line cut off by a crash is ignored.
+# Unless the run is to be resumed only the segment events are read (to delete the segments left behind),
+# which skips decoding the chunk entries holding every email address of the run.
+def readJournal(path, resume=False):
+    try:
+        journalFile = open(path, 'r', encoding='utf-8')
+    except FileNotFoundError:
+        return None
+    state = JournalState(resume)
+    with journalFile:
+        for line in journalFile:
+            if not resume and not line.startswith('{"event":"segment-'):
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            event = entry.get('event')
+            if event == 'run' and state.run is None:
+                state.run = entry
+            elif event == 'run-done':
+                state.finished = True
+            elif event == 'segment-created':
+                state.createdSegments.add(entry['segmentId'])
+            elif event == 'segment-deleted':
+                state.deletedSegments.add(entry['segmentId'])
+            elif event == 'retry-queued':
+                state.pendingRetries[entry['key']] = (entry['kind'], entry['item'])
+                if entry['kind'] == 'chunk':
+                    state.lastChunk = max(state.lastChunk, entry['item']['chunk'])
+            elif event == 'retry-finished':
+                state.pendingRetries.pop(entry['key'], None)
+            elif event == 'chunk-done':
+                state.completedChunks += 1
+                state.lastChunk = max(state.lastChunk, entry['chunk'])
+                for email in entry['emails']:
+                    state.completedEmails.add(email)
+    return state
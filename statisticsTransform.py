@@ -0,0 +1,114 @@
+# Turns campaign statistics responses of the CrossEngage UI API into output rows.
+# Used by fetchMessageStatistcs.py, kept separate so it can be benchmarked without network access.
+# Responses are decoded incrementally with ijson if it is installed (using its C backend when
+# available), otherwise they are decoded at once with orjson or, as last resort, the json module.
+
+import collections, json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND = ('ijson (' + ijson.backend + ')') if ijson else ('orjson' if orjson else 'json')
+
+BASE_FIELDS = ['Date', 'Campaign ID', 'Campaign Name', 'Message ID', 'Message Name', 'Message Channel']
+LONG_FIELDS = ['KPI', 'Value']
+
+# Map the ID of each KPI that should be exported to its name. IDs defined more than once
+# are left out, just like KPIs that are not in kpisToExport.
+def buildKpiIndex(kpiDefinitions, kpisToExport):
+    kpisToExport = set(kpisToExport)
+    idCounts = collections.Counter(str(kpi['id']) for kpi in kpiDefinitions)
+    return {str(kpi['id']): kpi['name'] for kpi in kpiDefinitions if idCounts[str(kpi['id'])] == 1 and kpi['name'] in kpisToExport}
+
+# Column names of the output for either layout
+def getFields(reduced, kpisToExport):
+    return BASE_FIELDS + (list(kpisToExport) if reduced else LONG_FIELDS)
+
+# Read a campaign statistics response from a binary file object (e.g. the raw response stream)
+# and yield a (day, messageStatistics, description) tuple for every entry of its history.
+# With ijson the raw body and the decoded text of the response are never held in memory. Entries that
+# precede the description in the response are held back until it has been read, so if the history comes
+# first (as in the responses of benchmarks/mockServer.py) all of its entries are decoded before the first is yielded.
+def iterStatistics(fileObject):
+    if ijson is None:
+        campaignStatistics = orjson.loads(fileObject.read()) if orjson else json.load(fileObject)
+        description = campaignStatistics['description']
+        for day, messageStatistics in campaignStatistics['history'].items():
+            yield day, messageStatistics, description
+        return
+    description = None
+    pendingDays = []
+    builder = None
+    for prefix, event, value in ijson.parse(fileObject, use_float=True):
+        if builder is None:
+            if event == 'map_key' and prefix == 'history':
+                target, day = 'history', value
+                builder, depth = ijson.ObjectBuilder(), 0
+            elif event == 'map_key' and prefix == '' and value == 'description':
+                target = 'description'
+                builder, depth = ijson.ObjectBuilder(), 0
+            continue
+        builder.event(event, value)
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+        if depth > 0:
+            continue
+        if target == 'description':
+            description = builder.value
+            for pendingDay, messageStatistics in pendingDays:
+                yield pendingDay, messageStatistics, description
+            pendingDays = []
+        elif description is None:
+            pendingDays.append((day, builder.value))
+        else:
+            yield day, builder.value, description
+        builder = None
+    if pendingDays:
+        raise ValueError('Statistics response without description')
+
+# Generate the output rows for one campaign statistics response in a single pass.
+# In the reduced layout there is one row per message and day with a column per KPI,
+# otherwise there is one row per message, day and KPI.
+def buildRows(campaign, campaignStatistics, kpiIndex, reduced):
+    description = campaignStatistics['description']
+    return buildRowsFromHistory(campaign, ((day, messageStatistics, description) for day, messageStatistics in campaignStatistics['history'].items()), kpiIndex, reduced)
+
+# Same as buildRows() for the (day, messageStatistics, description) tuples of iterStatistics()
+def buildRowsFromHistory(campaign, history, kpiIndex, reduced):
+    campaignId = campaign['id']
+    campaignName = campaign['name']
+    for day, messageStatistics, description in history:
+        date = day[:10]
+        for messageStatistic in messageStatistics:
+            messageId = messageStatistic['id']
+            messageDetails = description[messageId]
+            result = {
+                'Date': date,
+                'Campaign ID': campaignId,
+                'Campaign Name': campaignName,
+                'Message ID': messageId,
+                'Message Name': messageDetails['name'],
+                'Message Channel': messageDetails['channelType']
+            }
+            if reduced:
+                for kpiId, value in messageStatistic['values'].items():
+                    kpiName = kpiIndex.get(kpiId)
+                    if kpiName is not None:
+                        result[kpiName] = value
+                yield result
+            else:
+                for kpiId, value in messageStatistic['values'].items():
+                    kpiName = kpiIndex.get(kpiId)
+                    if kpiName is not None:
+                        row = result.copy()
+                        row['KPI'] = kpiName
+                        row['Value'] = value
+                        yield row
@@ -0,0 +1,124 @@
+# Output formats for the rows generated by statisticsTransform.py.
+# Every writer takes rows through writeRows() as they are generated and is closed once at the end.
+
+import csv, datetime, gzip
+
+FORMATS = ['csv', 'parquet', 'arrow']
+
+# Row-wise csv output, optionally gzip compressed
+class CsvStatisticsWriter:
+    def __init__(self, targetFile, fields, compress=False):
+        self.compress = compress
+        if compress:
+            self.file = gzip.open(targetFile, 'wt', newline='', encoding='utf-8')
+        else:
+            self.file = open(targetFile, 'w+', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.file, fieldnames=fields)
+        self.writer.writeheader()
+
+    def writeRows(self, rows):
+        self.writer.writerows(rows)
+        if not self.compress:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# Typed columnar output as Parquet or Arrow IPC file, written in record batches.
+# Campaign name, message and channel columns (and the KPI name in the long layout) are
+# dictionary encoded. For Arrow IPC each column keeps one growing dictionary for the whole file
+# so that consecutive batches only add dictionary deltas. For Parquet each batch is encoded on its own
+# and the batches are buffered into row groups of rowGroupSize rows, as every row group stores the
+# dictionaries of its column chunks and small row groups would repeat them over and over.
+class ArrowStatisticsWriter:
+    DICTIONARY_FIELDS = ['Campaign Name', 'Message ID', 'Message Name', 'Message Channel', 'KPI']
+
+    def __init__(self, targetFile, fields, fileFormat, batchSize=10000, rowGroupSize=1000000):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError('The ' + fileFormat + ' format requires pyarrow, install it with pip3 install pyarrow')
+        self.pa = pyarrow
+        self.fields = fields
+        self.batchSize = batchSize
+        self.rowGroupSize = rowGroupSize
+        self.buffer = []
+        self.pendingBatches = [] # Parquet batches not yet written as row group
+        self.pendingRows = 0
+        self.parquet = fileFormat == 'parquet'
+        self.dictionaries = {field: {} for field in fields if field in self.DICTIONARY_FIELDS}
+        schemaFields = []
+        for field in fields:
+            if field == 'Date':
+                fieldType = pyarrow.date32()
+            elif field == 'Campaign ID':
+                fieldType = pyarrow.int64()
+            elif field in self.dictionaries:
+                fieldType = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+            else: # KPI values
+                fieldType = pyarrow.int64()
+            schemaFields.append(pyarrow.field(field, fieldType))
+        self.schema = pyarrow.schema(schemaFields)
+        if self.parquet:
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(targetFile, self.schema, compression='zstd')
+        else:
+            import pyarrow.ipc
+            self.writer = pyarrow.ipc.new_file(targetFile, self.schema, options=pyarrow.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+    def writeRows(self, rows):
+        self.buffer.extend(rows)
+        while len(self.buffer) >= self.batchSize:
+            self.writeBatch(self.buffer[:self.batchSize])
+            del self.buffer[:self.batchSize]
+
+    def writeBatch(self, rows):
+        pa = self.pa
+        columns = []
+        for field in self.fields:
+            values = [row.get(field) for row in rows]
+            if field == 'Date':
+                columns.append(pa.array([datetime.date.fromisoformat(value) for value in values], type=pa.date32()))
+            elif field in self.dictionaries and self.parquet:
+                columns.append(pa.array(values, type=pa.string()).dictionary_encode())
+            elif field in self.dictionaries:
+                dictionary = self.dictionaries[field]
+                indices = [dictionary.setdefault(value, len(dictionary)) if value is not None else None for value in values]
+                columns.append(pa.DictionaryArray.from_arrays(pa.array(indices, type=pa.int32()), pa.array(list(dictionary), type=pa.string())))
+            else:
+                # pyarrow truncates floats into int64 columns without complaint, so fractional values are rejected
+                for value in values:
+                    if isinstance(value, float) and not value.is_integer():
+                        raise ValueError('Non-integer value ' + str(value) + ' for ' + field + ' cannot be written to the ' + ('parquet' if self.parquet else 'arrow') + ' format, use csv instead')
+                columns.append(pa.array(values, type=pa.int64()))
+        batch = pa.RecordBatch.from_arrays(columns, schema=self.schema)
+        if self.parquet:
+            self.pendingBatches.append(batch)
+            self.pendingRows += batch.num_rows
+            if self.pendingRows >= self.rowGroupSize:
+                self.writeRowGroup()
+        else:
+            self.writer.write_batch(batch)
+
+    # The dictionaries of the batches are unified first, Parquet falls back to plain encoding if they change within a column chunk
+    def writeRowGroup(self):
+        rowGroup = self.pa.Table.from_batches(self.pendingBatches, schema=self.schema).unify_dictionaries()
+        self.writer.write_table(rowGroup, row_group_size=self.rowGroupSize)
+        self.pendingBatches = []
+        self.pendingRows = 0
+
+    def close(self):
+        if self.buffer:
+            self.writeBatch(self.buffer)
+            self.buffer = []
+        if self.pendingBatches:
+            self.writeRowGroup()
+        self.writer.close()
+
+def openWriter(targetFile, fields, fileFormat='csv', compress=False):
+    if fileFormat == 'csv':
+        return CsvStatisticsWriter(targetFile, fields, compress)
+    elif fileFormat in FORMATS:
+        return ArrowStatisticsWriter(targetFile, fields, fileFormat)
+    else:
+        raise ValueError('Unknown output format ' + fileFormat)